@@ -48,7 +48,7 @@ class Primitives(object):
                             primitives=GL_LINES)
 
         # create a subdivided quad to be drawn
-        ixs, quad, texs = make_unit_quad_tile(64)
+        ixs, quad, texs = make_unit_quad_tile(64, shared=True)
         
         
         # grid shader, across the whole sphere
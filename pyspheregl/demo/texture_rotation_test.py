@@ -21,7 +21,7 @@ class TextureRotationTest(object):
         touch_fn=self.touch)
         self.rotater = RotationHandler()                
 
-        ixs, quad, texs = make_unit_quad_tile(1)
+        ixs, quad, texs = make_unit_quad_tile(1, shared=True)
         
         world_shader= shader_from_file([getshader("sphere.vert"), getshader("user/whole_sphere.vert")], [getshader("sphere.vert"), getshader("user/whole_sphere_tex_rotatable.frag")])
 
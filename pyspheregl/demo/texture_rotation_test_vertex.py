@@ -21,7 +21,7 @@ class TextureRotationTest(object):
         touch_fn=self.touch)
         self.rotater = RotationHandler()                
 
-        ixs, quad, texs = make_unit_quad_tile(256)
+        ixs, quad, texs = make_unit_quad_tile(256, shared=True)
         
         world_shader= shader_from_file([getshader("sphere.vert"), getshader("user/whole_sphere_tex_rotate.vert")], [getshader("user/whole_sphere_tex.frag")])
 
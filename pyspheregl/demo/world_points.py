@@ -37,7 +37,7 @@ class WorldPoints(object):
         touch_fn=self.touch)
         self.rotater = RotationHandler(rotater.EQUATORIAL)                
         
-        world_indices, world_verts, world_texs = make_unit_quad_tile(1)            
+        world_indices, world_verts, world_texs = make_unit_quad_tile(1, shared=True)            
         world_texture = pyglet.image.load(resource_file("data/azworld.png"))
         whole_shader = shader_from_file([getshader("sphere.vert"), getshader("user/whole_sphere.vert")], [getshader("user/whole_sphere_tex.frag")]) 
         self.world_render = ShaderVBO(whole_shader, IBuf(world_indices), 
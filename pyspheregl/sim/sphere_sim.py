@@ -10,7 +10,8 @@ from ..utils import glskeleton,  gloffscreen, np_vbo, shader
 from ..sphere import sphere
 from ..utils.graphics_utils import make_unit_quad_tile
 from ..sim.sim_rotation_manager import RotationManager
-from ..sim.touch_manager import ZMQTouchHandler
+from ..sim.touch_manager import ZMQTouchHandler, ThreadedZMQTouchHandler
+from ..utils.latency import LatencyTracer
 
 
 
@@ -50,6 +51,11 @@ class SphereViewer:
         self.fbo = gloffscreen.FBOContext(self.size, self.size)
         self.touch_fbo = gloffscreen.FBOContext(self.window_size[0], self.window_size[1], texture=False)
 
+        # asynchronous readback of the touch feedback buffer
+        if self.feedback_mode=="pbo":
+            self.feedback_readback = gloffscreen.PBOReadback(self.fbo.touch_texture, self.feedback_buf, 
+                                                            n_buffers=self.feedback_buffers)
+
         self.finger_point_shader = mkshader(["sphere.vert", "sphere_sim/finger_point_nice.vert"], 
         ["sphere_sim/finger_point_nice.frag"])     
         self.finger_line_shader = mkshader(["sphere.vert", "sphere_sim/finger_line.vert"],  
@@ -62,7 +68,7 @@ class SphereViewer:
                                     ["user/whole_sphere_tex.frag"])        
         
         n_subdiv = 128        
-        quad_indices, quad_verts, _ = make_unit_quad_tile(n_subdiv)    
+        quad_indices, quad_verts, _ = make_unit_quad_tile(n_subdiv, shared=True)    
         qverts = np_vbo.VBuf(quad_verts)      
         qixs = np_vbo.IBuf(quad_indices)
         self.sphere_quad_ibuf = qixs
@@ -77,11 +83,12 @@ class SphereViewer:
         
 
         # this will hold positions of active touches for drawing
-        self.touch_pts = np.zeros((256, 3))        
-        self.touch_buf = np_vbo.VBuf(self.touch_pts)
+        self.touch_pts = np.zeros((256, 3), dtype=np.float32)
+        self.touch_pts[:,1] = -np.pi
+        self.touch_buf = np_vbo.StreamVBuf(self.touch_pts)
 
         # whols ecreen shader
-        quad_indices, quad_verts, _ = make_unit_quad_tile(1)            
+        quad_indices, quad_verts, _ = make_unit_quad_tile(1, shared=True)            
 
         screen_shader =mkshader(["sphere_sim/screen_quad.vert"], ["sphere_sim/screen_quad.frag"]) 
         self.screen_render = shader.ShaderVBO(screen_shader, np_vbo.IBuf(quad_indices),
@@ -98,7 +105,7 @@ class SphereViewer:
                                          buffers={"position":self.touch_buf},
                                          primitives=GL_LINES)
         # simple quad render for testing
-        world_indices, world_verts, world_texs = make_unit_quad_tile(64)            
+        world_indices, world_verts, world_texs = make_unit_quad_tile(64, shared=True)            
         
 
         self.world_render = shader.ShaderVBO(self.whole_shader, np_vbo.IBuf(world_indices), 
@@ -115,7 +122,9 @@ class SphereViewer:
 
     def __init__(self,  product, exit_fn=None,  auto_spin=False, draw_fn=None, 
         tick_fn=None, debug_grid=0.1, test_render=False, show_touches=True, key_fn=None, mouse_fn=None,
-        zmq_address="tcp://localhost:4000", touch_fn=None, simulate_touches = True):
+        zmq_address="tcp://localhost:4000", touch_fn=None, simulate_touches = True, 
+        feedback_mode="sync", feedback_buffers=2, wire_format="json", coalesce_touches=False, touch_hwm=None,
+        threaded_touches=False, trace_latency=False, latency_log_every=10.0, cluster_size=0):
         
     
         self.product = product
@@ -142,12 +151,38 @@ class SphereViewer:
 
         self.window_size = window_size
         self.skeleton = glskeleton.GLSkeleton(draw_fn = self.redraw, resize_fn = self.resize, 
-                                              tick_fn=self.tick, mouse_fn=self.mouse, key_fn=self.key, exit_fn=self._exit, window_size=window_size)
+                                              tick_fn=self.tick, mouse_fn=self.mouse, key_fn=self.key, exit_fn=self._exit, window_size=window_size,
+                                              flip_fn=self.flipped)
 
         # texture read back from the GPU representing touchable objects
-        self.feedback_buf = np.zeros((self.size, self.size), dtype=np.uint32)
-        
-        self.touch_manager = ZMQTouchHandler(zmq_address, feedback_buf=self.feedback_buf)
+        # feedback_mode is either "sync" (read the whole buffer every frame, blocking)
+        # or "pbo" (read asynchronously via a ring of feedback_buffers PBOs; 
+        # results lag by up to feedback_buffers-1 frames, but never stall the pipeline)
+        # or "sparse" (no copy of the buffer; only the pixels under active touches are read)
+        if feedback_mode not in ("sync", "pbo", "sparse"):
+            raise ValueError("Unknown feedback mode '%s'" % feedback_mode)
+        self.feedback_mode = feedback_mode
+        self.feedback_buffers = feedback_buffers
+        # coalesce_touches merges all the touch frames received since the last tick
+        # into one set of events; touch_hwm limits the number of queued frames
+        # threaded_touches receives touches and builds events on a background thread
+        # trace_latency measures the time from touches arriving at touch_zmq to the frame 
+        # that draws them, printing a summary every latency_log_every seconds
+        self.latency = LatencyTracer(log_every=latency_log_every) if trace_latency else None
+        # cluster_size > 0 groups touches closer than this (in radians) and adds CLUSTER_* events
+        touch_args = dict(wire_format=wire_format, hwm=touch_hwm, latency=self.latency, cluster_size=cluster_size)
+        if threaded_touches:
+            touch_handler = ThreadedZMQTouchHandler
+        else:
+            touch_handler = ZMQTouchHandler
+            touch_args["coalesce"] = coalesce_touches
+        if feedback_mode=="sparse":
+            self.feedback_buf = None
+            self.touch_manager = touch_handler(zmq_address, feedback_buf=None, feedback_fn=self.sparse_feedback, 
+                                               **touch_args)
+        else:
+            self.feedback_buf = np.zeros((self.size, self.size), dtype=np.uint32)
+            self.touch_manager = touch_handler(zmq_address, feedback_buf=self.feedback_buf, **touch_args)
         self.simulate_touches = simulate_touches
 
         
@@ -164,6 +199,8 @@ class SphereViewer:
     def _exit(self):
         if self.exit_fn is not None:
             self.exit_fn()
+        if isinstance(self.touch_manager, ThreadedZMQTouchHandler):
+            self.touch_manager.stop()
         
     # called to exit the simulator
     def exit(self):
@@ -254,9 +291,11 @@ class SphereViewer:
             self.touch_pts[i+1, 2] = 0            
             i += 2
 
-        self.touch_buf.set(self.touch_pts)
-        self.touch_line_render.draw()      
-        self.touch_render.draw()
+        # only upload and draw the rows written this frame; uploading
+        # from row 0 orphans the buffer, so this never waits for the last frame's draw
+        self.touch_buf.set(self.touch_pts, 0, i)
+        self.touch_line_render.draw(n_vtxs=i)      
+        self.touch_render.draw(n_vtxs=i)
                         
     
     def redraw(self):          
@@ -318,12 +357,39 @@ class SphereViewer:
             # render onto a flat quad
             self.screen_render.draw()
 
+        if self.latency is not None:
+            self.latency.stamp("submit")
+
         # retrieve the feedback buffer
-        glBindTexture(self.fbo.touch_texture.target, self.fbo.touch_texture.id)
-           
-        glGetTexImage(self.fbo.touch_texture.target, 0, GL_RED_INTEGER, 
-        GL_UNSIGNED_INT, self.feedback_buf.ctypes.data)        
-        
+        self.read_feedback()
+
+    def flipped(self):
+        # the frame drawn for the touches dispatched this tick is now being displayed
+        if self.latency is not None:
+            self.latency.stamp("flip")
+            self.latency.complete()
+
+    def sparse_feedback(self, lonlats):
+        # look up the touch buffer directly under each of the given
+        # lon, lat points; this is called by the touch manager
+        # during tick(), so the buffer holds the last rendered frame
+        xy = sphere.np_polar_to_display(lonlats, resolution=self.size)
+        np.clip(xy, 0, self.size-1, out=xy)
+        return self.fbo.read_touch_ids(xy[:,0], xy[:,1])
+
+    def read_feedback(self):
+        # copy the touch buffer back into feedback_buf, where
+        # the touch manager can look up the ids under each touch
+        if self.feedback_mode=="sparse":
+            # nothing to do; read on demand in sparse_feedback
+            return
+        if self.feedback_mode=="pbo":
+            self.feedback_readback.read()
+        else:
+            glBindTexture(self.fbo.touch_texture.target, self.fbo.touch_texture.id)           
+            glGetTexImage(self.fbo.touch_texture.target, 0, GL_RED_INTEGER, 
+            GL_UNSIGNED_INT, self.feedback_buf.ctypes.data)        
+
             
 
         
@@ -2,13 +2,20 @@ import zmq
 import numpy as np
 import json
 import attr
+import copy
+import heapq
+import threading
+import timeit
+wall_clock = timeit.default_timer
 
 from ..sphere import sphere
+from ..touch.wire_format import decode_touch_frame, JSON_TOPIC, BINARY_TOPIC
 
 @attr.s
 class TouchEvent(object):
     event = attr.ib(default="NONE")
     touch = attr.ib(default=None)
+    cluster = attr.ib(default=None) # for CLUSTER_JOIN and CLUSTER_LEAVE
 
 @attr.s
 class Touch(object):
@@ -34,174 +41,672 @@ class Cluster(Touch):
     children = attr.ib(default=None)    
     
 
+class TouchTable(object):
+    """Preallocated struct-of-arrays storage for touches. Each touch occupies
+    a slot, which is a row of every column. Free slots are kept in a heap,
+    so the lowest numbered free slot is always used next. The table doubles
+    in size if it runs out of slots."""
+    pair_columns = ["lonlat", "origin", "raw"]
+    float_columns = ["orig_t", "t", "duration"]
+    int_columns = ["fseq", "feedback"]
+
+    def __init__(self, capacity=32):
+        self.capacity = 0
+        self.free = []
+        self.ids = []
+        self.parents = [] # the Cluster each touch belongs to, if any
+        self.now = 0.0 # time of the latest frame, for dead_time
+        for name in self.pair_columns:
+            setattr(self, name, np.zeros((0, 2)))
+        for name in self.float_columns:
+            setattr(self, name, np.zeros(0))
+        for name in self.int_columns:
+            setattr(self, name, np.zeros(0, dtype=np.int64))
+        self.alive = np.zeros(0, dtype=bool)
+        self.grow(capacity)
+
+    def grow(self, capacity):
+        # enlarge every column to the given capacity, keeping the contents
+        for name in self.pair_columns+self.float_columns+self.int_columns+["alive"]:
+            old = getattr(self, name)
+            new = np.zeros((capacity,)+old.shape[1:], dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+        self.ids.extend([None]*(capacity-self.capacity))
+        self.parents.extend([None]*(capacity-self.capacity))
+        for slot in range(self.capacity, capacity):
+            heapq.heappush(self.free, slot)
+        self.capacity = capacity
+
+    def allocate(self):
+        """Return the lowest free slot"""
+        if len(self.free)==0:
+            self.grow(self.capacity*2)
+        return heapq.heappop(self.free)
+
+    def snapshot(self, slot):
+        """Return a new one-slot table holding a copy of the given slot"""
+        table = TouchTable(capacity=1)
+        table.allocate()
+        for name in self.pair_columns+self.float_columns+self.int_columns+["alive"]:
+            getattr(table, name)[0] = getattr(self, name)[slot]
+        table.ids[0], table.parents[0], table.now = self.ids[slot], self.parents[slot], self.now
+        return table
+
+    def release(self, slot):
+        self.ids[slot] = None
+        self.parents[slot] = None
+        heapq.heappush(self.free, slot)
+
+    def start(self, slot, id, origin, lonlat, raw, orig_t, t, fseq, feedback, alive=True):
+        # fill in a newly allocated slot
+        self.ids[slot] = id
+        self.origin[slot], self.lonlat[slot], self.raw[slot] = origin, lonlat, raw
+        self.orig_t[slot], self.t[slot], self.duration[slot] = orig_t, t, t-orig_t
+        self.fseq[slot], self.feedback[slot], self.alive[slot] = fseq, feedback, alive
+
+
+def _pair_column(name):
+    def get(self):
+        return tuple(getattr(self.table, name)[self.slot].tolist())
+    def set(self, value):
+        getattr(self.table, name)[self.slot] = value
+    return property(get, set)
+
+def _scalar_column(name, kind):
+    def get(self):
+        return kind(getattr(self.table, name)[self.slot])
+    def set(self, value):
+        getattr(self.table, name)[self.slot] = value
+    return property(get, set)
+
+class TouchView(object):
+    """A view of one slot of a TouchTable, with the same attributes as Touch.
+    copy.copy() returns a detached Touch with the current values. When the
+    touch expires, the view is moved to a copy of its slot, so it keeps
+    its final values after the slot is reused."""
+    __slots__ = ["table", "slot", "active_touch"]
+    def __init__(self, table, slot):
+        self.table = table
+        self.slot = slot
+        self.active_touch = slot
+
+    lonlat = _pair_column("lonlat")
+    origin = _pair_column("origin")
+    raw = _pair_column("raw")
+    orig_t = _scalar_column("orig_t", float)
+    t = _scalar_column("t", float)
+    duration = _scalar_column("duration", float)
+    fseq = _scalar_column("fseq", int)
+    feedback = _scalar_column("feedback", int)
+    alive = _scalar_column("alive", bool)
+
+    @property
+    def parent(self):
+        return self.table.parents[self.slot]
+
+    @parent.setter
+    def parent(self, value):
+        self.table.parents[self.slot] = value
+
+    @property
+    def id(self):
+        return self.table.ids[self.slot]
+
+    @property
+    def dead_time(self):
+        # time since the touch was last seen, if it has been lifted
+        if self.table.alive[self.slot]:
+            return 0.0
+        return self.table.now - float(self.table.t[self.slot])
+
+    def __copy__(self):
+        return Touch(lonlat=self.lonlat, origin=self.origin, orig_t=self.orig_t, raw=self.raw, t=self.t,
+                     fseq=self.fseq, duration=self.duration, dead_time=self.dead_time, 
+                     active_touch=self.active_touch, id=self.id, alive=self.alive, parent=self.parent, 
+                     feedback=self.feedback)
+
+    def __repr__(self):
+        return "TouchView(slot=%d, %r)" % (self.active_touch, copy.copy(self))
+
+
 def np_spherical_distance(p1, p2):
     """Given two points p1, p2 (in radians), return
     the great circle distance between the two points."""
     dlon = p2[0] - p1[0]        
     lat1, lat2 = p1[1], p2[1]
     return np.arccos(np.sin(lat1)*np.sin(lat2) + np.cos(lat1)*np.cos(lat2) * np.cos(dlon))
-    
-from scipy.spatial.distance import pdist, squareform
+
+def np_lonlat_to_unit(lonlat):
+    """Convert an (N,2) array of lon, lats (in radians) to an (N,3) array of unit vectors"""
+    lon, lat = lonlat[:,0], lonlat[:,1]
+    return np.stack([np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)], axis=1)
+
+def np_unit_to_lonlat(pts):
+    """Convert an (N,3) array of unit vectors to an (N,2) array of lon, lats"""
+    return np.stack([np.arctan2(pts[:,1], pts[:,0]), np.arcsin(np.clip(pts[:,2], -1, 1))], axis=1)
+
+_neighbour_cells = [(i, j, k) for i in (-1,0,1) for j in (-1,0,1) for k in (-1,0,1)]
+
+def close_pairs(pts, threshold):
+    """Return two index arrays (froms, tos), with froms>tos, of the pairs of unit 
+    vectors in pts that are less than threshold radians apart.
+    Points are hashed into a grid of cubes whose sides are the chord length of 
+    threshold, so only points in neighbouring cells are compared."""
+    threshold = min(threshold, np.pi)
+    side = max(2*np.sin(threshold/2), 1e-9)
+    keys = [tuple(key) for key in np.floor(pts/side).astype(np.int64).tolist()]
+    cells = {}
+    for i, key in enumerate(keys):
+        cells.setdefault(key, []).append(i)
+    froms, tos = [], []
+    for i, (x, y, z) in enumerate(keys):
+        for dx, dy, dz in _neighbour_cells:
+            for j in cells.get((x+dx, y+dy, z+dz), ()):
+                if j<i:
+                    froms.append(i)
+                    tos.append(j)
+    froms, tos = np.array(froms, dtype=np.int64), np.array(tos, dtype=np.int64)
+    if len(froms)==0:
+        return froms, tos
+    close = np.einsum("ij,ij->i", pts[froms], pts[tos]) > np.cos(threshold)
+    return froms[close], tos[close]
 
 def cluster_touches(touches, threshold):
-    distances = squareform(pdist(np.array(touches), np_spherical_distance))
-    ixs = np.tril(np.where(distances<threshold,1 ,0), -1)
-    return np.nonzero(ixs)
-    
+    # pairs of indices of lon, lat touches closer than threshold
+    return close_pairs(np_lonlat_to_unit(np.array(touches, dtype=np.float64)), threshold)
+
+
+class UnionFind(object):
+    """Disjoint sets of the integers 0..n-1"""
+    def __init__(self, n):
+        self.parent = list(range(n))
+
+    def find(self, i):
+        root = i
+        while self.parent[root]!=root:
+            root = self.parent[root]
+        # path compression
+        while self.parent[i]!=root:
+            self.parent[i], i = root, self.parent[i]
+        return root
+
+    def union(self, i, j):
+        ri, rj = self.find(i), self.find(j)
+        if ri!=rj:
+            self.parent[max(ri, rj)] = min(ri, rj)
+
 
 class ClusterSet(object):
-    def __init__(self, cluster_size):
-        self.clusters = []
-        self.cluster_map = {} # maps touch ids to clusters
+    """Groups touches into clusters of closely spaced fingers, and tracks them from
+    frame to frame. Touches less than cluster_size radians apart are connected;
+    each connected group of at least min_size touches is a Cluster, whose lonlat 
+    is the centroid of its children and whose radius is the distance from there
+    to the furthest child.
+
+    Groups are found each frame with a union-find over the pairs from close_pairs(),
+    so the cost is proportional to the number of touches. Each group keeps the id of
+    the previous cluster it shares the most touches with, so ids are stable while
+    touches join and leave."""
+    def __init__(self, cluster_size, min_size=2):
+        self.clusters = {} # maps cluster ids to clusters
+        self.cluster_map = {} # maps touch ids to cluster ids
+        self.members = {} # maps touch ids to touches, for touches in a cluster
         self.cluster_size = cluster_size
+        self.min_size = min_size
+        self.next_id = 0
 
-    def update(self, active_touches):
-        if len(active_touches)>0:
-            touches = []
-            for touch in active_touches:
-                touches.append(active_touches[touch].lonlat)            
-            tfrom, tto = cluster_touches(np.array(touches), self.cluster_size)
+    def groups(self, touches):
+        # find the connected groups of touches; returns the groups (as lists
+        # of indices), the touch ids and their unit vectors
+        ids = list(touches.keys())
+        if len(ids)<self.min_size:
+            return [], ids, None
+        pts = np_lonlat_to_unit(np.array([touches[id].lonlat for id in ids], dtype=np.float64))
+        sets = UnionFind(len(ids))
+        for i, j in zip(*close_pairs(pts, self.cluster_size)):
+            sets.union(i, j)
+        groups = {}
+        for i in range(len(ids)):
+            groups.setdefault(sets.find(i), []).append(i)
+        return [group for group in groups.values() if len(group)>=self.min_size], ids, pts
 
+    def match(self, groups, ids):
+        # map group indices to the ids of the previous clusters that share
+        # the most touches with them; each cluster is matched at most once
+        candidates = []
+        for g, group in enumerate(groups):
+            shared = {}
+            for i in group:
+                cluster_id = self.cluster_map.get(ids[i])
+                if cluster_id is not None:
+                    shared[cluster_id] = shared.get(cluster_id, 0)+1
+            candidates.extend((-n, g, cluster_id) for cluster_id, n in shared.items())
+        matched, claimed = {}, set()
+        for _, g, cluster_id in sorted(candidates):
+            if g not in matched and cluster_id not in claimed:
+                matched[g] = cluster_id
+                claimed.add(cluster_id)
+        return matched
 
-    def update_connectivity(self, froms, tos, active_touches):
-        """Take a list of connected id pairs; update the connectivity of the
-           cluster set.
-           `pairs` should specify indices into active_touches, 
-           which should map those indices to Touch objects
-        """
-        for frm, to in zip(froms, tos):
-            frm_id = active_touches[frm].id
-            to_id = active_touches[to].id
+    def update(self, touches, t):
+        """Update the clusters from a dictionary of live touches, returning the
+        events: CLUSTER_LEAVE, CLUSTER_UP, CLUSTER_DOWN, CLUSTER_JOIN and CLUSTER_DRAG,
+        in that order. JOIN and LEAVE events have the child as their touch, 
+        and the cluster as their cluster."""
+        groups, ids, pts = self.groups(touches)
+        matched = self.match(groups, ids)
+        leaves, ups, downs, joins, drags = [], [], [], [], []
+        cluster_map, members, kept = {}, {}, set()
+        for g, group in enumerate(groups):
+            children = [ids[i] for i in group]
+            centre = np.sum(pts[group], axis=0)
+            norm = np.linalg.norm(centre)
+            centre = centre/norm if norm>1e-9 else pts[group[0]]
+            lonlat = tuple(np_unit_to_lonlat(centre[None,:])[0].tolist())
+            radius = float(np.max(np.arccos(np.clip(np.dot(pts[group], centre), -1, 1))))
+            if g in matched:
+                cluster = self.clusters[matched[g]]
+                old = set(cluster.children)
+                cluster.lonlat, cluster.t, cluster.duration = lonlat, t, t-cluster.orig_t
+                cluster.radius, cluster.children = radius, children
+                drags.append(TouchEvent(event="CLUSTER_DRAG", touch=cluster))
+            else:
+                cluster = Cluster(lonlat=lonlat, origin=lonlat, orig_t=t, raw=None, t=t, id=self.next_id,
+                                  alive=True, radius=radius, children=children)
+                self.next_id += 1
+                self.clusters[cluster.id] = cluster
+                old = set()
+                downs.append(TouchEvent(event="CLUSTER_DOWN", touch=cluster))
+            kept.add(cluster.id)
+            for child in children:
+                cluster_map[child], members[child] = cluster.id, touches[child]
+                if child not in old:
+                    joins.append(TouchEvent(event="CLUSTER_JOIN", touch=touches[child], cluster=cluster))
+
+        # touches which are no longer in the same cluster (including lifted touches)
+        for child, cluster_id in self.cluster_map.items():
+            if cluster_map.get(child)!=cluster_id:
+                leaves.append(TouchEvent(event="CLUSTER_LEAVE", touch=self.members[child], 
+                                         cluster=self.clusters[cluster_id]))
+                if child not in members:
+                    self.members[child].parent = None
+        for cluster_id in list(self.clusters.keys()):
+            if cluster_id not in kept:
+                cluster = self.clusters.pop(cluster_id)
+                cluster.alive = False
+                ups.append(TouchEvent(event="CLUSTER_UP", touch=cluster))
+        for child, touch in members.items():
+            touch.parent = self.clusters[cluster_map[child]]
+        self.cluster_map, self.members = cluster_map, members
+        return leaves+ups+downs+joins+drags
 
-            
+
+def buffer_feedback(feedback_buf, lonlat):
+    # using the feedback array, look up 
+    # the object id underneath this touch point
+    if feedback_buf is not None:
+        size = feedback_buf.shape[0]
+        # feedback buffers must be square!        
+        x, y = sphere.polar_to_display(lonlat[0], lonlat[1], size)            
+        return feedback_buf[int(y),int(x)]
+    else:
+        return -1
 
 
 # convert raw frame positions into a stream of events
 # either up, drag or down. Remembers origin of drags, and
 # tracks duration. Also provides a stable, dense numbering of active touches
 class TouchManager:
-    def __init__(self, linger_time=2.0, feedback_buf=None, cluster_size=0):
+    def __init__(self, linger_time=2.0, feedback_buf=None, cluster_size=0, feedback_fn=None, capacity=32):
+        # touch state is stored in a TouchTable; these dictionaries hold TouchViews of it
+        self.table = TouchTable(capacity)
         self.touches = {}        
         self.feedback_buf = feedback_buf
+        # if given, feedback_fn takes an (N,2) array of lon, lats
+        # and returns the N ids underneath them, instead of using feedback_buf
+        self.feedback_fn = feedback_fn
         # stable, but low numbered slots
         self.active_touches = {}     
         self.graveyard = {}
-        self.clusters = {}
+        # heap of (expiry time, slot, id) for touches lingering after being lifted
+        self.expiry = []
         self.touch_linger_time = linger_time
+        # clustering is disabled if cluster_size is 0
         self.cluster_set = ClusterSet(cluster_size)
+        self.clusters = self.cluster_set.clusters
 
     
     def feedback(self, lonlat):
-        # using the feedback array, look up 
-        # the object id underneath this touch point
-        if self.feedback_buf is not None:
-            size = self.feedback_buf.shape[0]
-            # feedback buffers must be square!        
-            x, y = sphere.polar_to_display(lonlat[0], lonlat[1], size)            
-            return self.feedback_buf[int(y),int(x)]
-        else:
-            return -1
-
+        return buffer_feedback(self.feedback_buf, lonlat)
 
+    def frame_feedback(self, frame_touches, ids):
+        # look up the feedback value of every touch in ids
+        # returns a dictionary mapping touch ids to feedback values
+        ids = list(ids)
+        if self.feedback_fn is not None:
+            if len(ids)==0:
+                return {}
+            lonlats = np.array([frame_touches[id] for id in ids], dtype=np.float64)
+            return dict(zip(ids, self.feedback_fn(lonlats)))
+        return {id:self.feedback(frame_touches[id]) for id in ids}
         
-    def touch_frame(self, frame_touches, raw, fseq, t):
+    def touch_frame(self, frame_touches, raw, fseq, t, first_seen=None, transient=None, last_seen=None):
+        """Process a complete frame of touches, returning the events.
+        When several frames have been coalesced into one, first_seen maps ids of
+        touches which appeared during them to their (origin, orig_t), transient
+        maps ids of touches which appeared and disappeared during them to dictionaries
+        of origin, orig_t, lonlat, raw, t and fseq, and last_seen maps ids of existing 
+        touches which disappeared during them to dictionaries of lonlat, raw, t and fseq."""
 
         # a new complete frame is issued
         existing, this_frame = set(self.touches.keys()), set(frame_touches.keys())        
         down, move, up = this_frame-existing, this_frame&existing, existing-this_frame
+        first_seen = first_seen or {}
+        transient = transient or {}
+        last_seen = last_seen or {}
 
-        #self.cluster_set.update(self.active_touches)
+        # look up what is under all of the current touches in one go
+        if transient:
+            frame_touches = dict(frame_touches)
+            frame_touches.update((touch, tr["lonlat"]) for touch, tr in transient.items())
+        feedback = self.frame_feedback(frame_touches, this_frame | set(transient))
 
+        table = self.table
         events = []
         for touch in down:
-            # new touch down
-
-            # find a slot
-            active_touch = 0
-            while active_touch in self.active_touches:
-                active_touch += 1
-
-            # read the value under the finger (i.e. what is being touched)
-        
-                                    
-            self.touches[touch] = Touch(origin=frame_touches[touch], lonlat=frame_touches[touch], orig_t=t,
-                                        t=t, fseq=fseq, duration=0.0, dead_time=0.0, active_touch=active_touch, id=touch, alive=True,
-                                        raw=raw[touch], feedback=self.feedback(frame_touches[touch]))            
-            self.active_touches[active_touch] = self.touches[touch]
+            # new touch down, in the lowest free slot
+            slot = table.allocate()
+            origin, orig_t = first_seen.get(touch, (frame_touches[touch], t))
+            table.start(slot, touch, origin, frame_touches[touch], raw[touch], orig_t, t, fseq, feedback[touch])
+            self.touches[touch] = self.active_touches[slot] = TouchView(table, slot)
             
             # create the event
             events.append(TouchEvent(event="DOWN", touch=self.touches[touch]))
+
+        for touch, tr in transient.items():
+            # touch down and up again since the last frame; goes straight to the graveyard
+            slot = table.allocate()
+            table.start(slot, touch, tr["origin"], tr["lonlat"], tr["raw"], tr["orig_t"], tr["t"], tr["fseq"], 
+                        feedback[touch], alive=False)
+            self.graveyard[touch] = self.active_touches[slot] = TouchView(table, slot)
+            heapq.heappush(self.expiry, (tr["t"]+self.touch_linger_time, slot, touch))
+            events.append(TouchEvent(event="DOWN", touch=self.graveyard[touch]))
+            events.append(TouchEvent(event="UP", touch=self.graveyard[touch]))
                         
-        for touch in move:
-            # touch move
-            self.touches[touch].lonlat = frame_touches[touch]
-            self.touches[touch].t = t
-            self.touches[touch].raw = raw[touch]
-            self.touches[touch].duration = t-self.touches[touch].orig_t
-            self.touches[touch].feedback = self.feedback(frame_touches[touch])
-            
-            events.append(TouchEvent(event="DRAG", touch=self.touches[touch]))
+        if len(move)>0:
+            # touch moves; update all the columns at once
+            move = list(move)
+            slots = np.array([self.touches[touch].slot for touch in move])
+            table.lonlat[slots] = [frame_touches[touch] for touch in move]
+            table.raw[slots] = [raw[touch] for touch in move]
+            table.feedback[slots] = [feedback[touch] for touch in move]
+            table.t[slots] = t
+            table.duration[slots] = t - table.orig_t[slots]
+            events.extend([TouchEvent(event="DRAG", touch=self.touches[touch]) for touch in move])
             
         for touch in up:
             # touch up
-            events.append(TouchEvent(event="UP", touch=self.touches[touch]))      
-            self.touches[touch].alive= False            
-            self.graveyard[touch] = self.touches[touch]
-            del self.touches[touch]
+            touch_obj = self.touches.pop(touch)
+            if touch in last_seen:
+                # update to the last position before it was lifted
+                history = last_seen[touch]
+                touch_obj.lonlat, touch_obj.raw = history["lonlat"], history["raw"]
+                touch_obj.t = history["t"]
+                touch_obj.duration = history["t"]-touch_obj.orig_t
+            events.append(TouchEvent(event="UP", touch=touch_obj))      
+            touch_obj.alive = False            
+            self.graveyard[touch] = touch_obj
+            heapq.heappush(self.expiry, (touch_obj.t+self.touch_linger_time, touch_obj.slot, touch))
+
+        # group the live touches into clusters
+        if self.cluster_set.cluster_size>0:
+            events.extend(self.cluster_set.update(self.touches, t))
 
         # clean up touches that have been dead for too long
-        for touch in list(self.graveyard.keys()):
-            touch_obj = self.graveyard[touch]
-            dead_time = t - touch_obj.t
-            touch_obj.dead_time = dead_time
-            if dead_time>self.touch_linger_time:
-                # remove the slot it was using            
-                del self.active_touches[touch_obj.active_touch]
+        # (dead_time is computed from the time of the latest frame)
+        table.now = t
+        while len(self.expiry)>0 and self.expiry[0][0]<t:
+            expiry_t, slot, touch = heapq.heappop(self.expiry)
+            # remove the slot it was using            
+            touch_obj = self.active_touches.pop(slot)
+            if self.graveyard.get(touch) is touch_obj:
                 del self.graveyard[touch]
+            # detach the view (which events and clients may still hold) from the slot 
+            # before it is reused, so it keeps its final values
+            touch_obj.table, touch_obj.slot = table.snapshot(slot), 0
+            table.release(slot)
         return {"events":events, "t":t, "fseq":fseq}
 
 
+def decode_frame(topic, data):
+    # decode a JSON or binary frame into a dictionary of touches, raw, fseq and t
+    if topic==JSON_TOPIC:
+        return json.loads(data)
+    frame = decode_touch_frame(data)
+    # JSON object keys are strings, so ids are strings in both formats
+    ids = [str(id) for id in frame["ids"].tolist()]
+    decoded = {"touches":dict(zip(ids, frame["lonlat"].tolist())),
+               "raw":dict(zip(ids, frame["raw"].tolist())),
+               "fseq":frame["fseq"], "t":frame["t"], "stale":frame["stale"]}
+    if "stamps" in frame:
+        decoded["stamps"] = frame["stamps"]
+    return decoded
+
+
 # Listen to incoming ZMQ events and parse into
 # up/down/drag events 
 class ZMQTouchHandler:
-    def __init__(self, zmq_address, feedback_buf, cluster_size=np.pi/8):
+    def __init__(self, zmq_address, feedback_buf, cluster_size=0, feedback_fn=None, wire_format="json",
+                 coalesce=False, hwm=None, latency=None):
+        """If coalesce is True, all the frames waiting when tick() is called are merged
+        into one, so a slow render loop never falls behind the touch stream.
+        hwm sets the ZMQ receive high water mark (the number of queued frames
+        before new ones are dropped).
+        cluster_size (in radians) enables CLUSTER_* events for touches closer than this;
+        0 (the default) disables clustering.
+        If latency is a LatencyTracer, frames that produce events are stamped
+        when received and dispatched, and added to it."""
         self.active_touches = {}
+        self.latency = latency
+        self.coalesce = coalesce
+        self.frames_coalesced = 0
         # create a zmq receiver and subscribe to touches
+        # in either JSON or packed binary format
+        if wire_format not in ("json", "binary"):
+            raise ValueError("wire_format must be json or binary")
+        self.topic = BINARY_TOPIC if wire_format=="binary" else JSON_TOPIC
         context = zmq.Context()
         socket = context.socket(zmq.SUB)
-        socket.setsockopt(zmq.SUBSCRIBE, "TOUCH")
+        socket.setsockopt(zmq.SUBSCRIBE, self.topic)
+        # ZMQ_CONFLATE is not used, as it does not support multipart messages
+        # (and would lose touches that went down and up between ticks)
+        if hwm is not None:
+            socket.setsockopt(zmq.RCVHWM, hwm)
         socket.connect(zmq_address)
         self.socket = socket
-        self.manager = TouchManager(feedback_buf=feedback_buf, cluster_size=cluster_size)
+        self.manager = TouchManager(feedback_buf=feedback_buf, cluster_size=cluster_size, feedback_fn=feedback_fn)
         
         
         
+    def decode(self, data):
+        return decode_frame(self.topic, data)
+        
+    def receive(self):
+        # read all of the frames waiting on the socket
+        frames = []
+        while self.socket.poll(timeout=0) != 0:
+            parts = self.socket.recv_multipart(zmq.NOBLOCK)       
+            if len(parts)==2:
+                frame = self.decode(parts[-1])
+                if self.latency is not None:
+                    # frames from older publishers only have t
+                    stamps = frame.setdefault("stamps", {"osc":frame["t"]})
+                    stamps["receive"] = wall_clock()
+                frames.append(frame)
+        return frames
+
+    def coalesce_frames(self, frames):
+        # merge a sequence of frames into the last one, recording the touches
+        # which appeared during the sequence, those that appeared and
+        # disappeared again before the end of it, and the last position
+        # of existing touches that were lifted
+        # (TUIO session ids are never reused, so existing touches that vanish
+        # and reappear within the sequence are not considered)
+        existing = set(self.manager.touches.keys())
+        seen = {}
+        for frame in frames:
+            for touch, lonlat in frame["touches"].items():
+                if touch not in seen:
+                    seen[touch] = {"origin":lonlat, "orig_t":frame["t"]}
+                seen[touch].update(lonlat=lonlat, raw=frame["raw"][touch], t=frame["t"], fseq=frame["fseq"])
+        last = frames[-1]
+        first_seen, transient, last_seen = {}, {}, {}
+        for touch, history in seen.items():
+            if touch in last["touches"]:
+                if touch not in existing:
+                    first_seen[touch] = history["origin"], history["orig_t"]
+            elif touch in existing:
+                last_seen[touch] = history
+            else:
+                transient[touch] = history
+        self.frames_coalesced += len(frames)-1
+        return dict(last, first_seen=first_seen, transient=transient, last_seen=last_seen)
+        
     def tick(self, touch_fn=None):
         # receive any waiting touch events, and dispatch 
         # to the touch handling function
-        waiting = self.socket.poll(timeout=0)
-        while waiting != 0:
-            if waiting != 0:
-                parts = self.socket.recv_multipart(zmq.NOBLOCK)       
-                if len(parts)==2:
-                    json_data = parts[-1]
-                    touch_data = json.loads(json_data)                
-                    
-                    # construct events
-                    events = self.manager.touch_frame(touch_data["touches"], 
-                                                    touch_data["raw"],
-                                                    fseq=touch_data["fseq"],
-                                                    t = touch_data["t"])
-                    # take a copy of the touches
-                    self.active_touches = self.manager.active_touches
-                    
-                    # call the callback
-                    if touch_fn is not None and len(events["events"])>0:
-                        touch_fn(events["events"])                    
-                        
-            waiting = self.socket.poll(timeout=0)
+        frames = self.receive()
+        if self.coalesce and len(frames)>1:
+            frames = [self.coalesce_frames(frames)]
+        for touch_data in frames:
+            # construct events
+            events = self.manager.touch_frame(touch_data["touches"], 
+                                            touch_data["raw"],
+                                            fseq=touch_data["fseq"],
+                                            t = touch_data["t"],
+                                            first_seen=touch_data.get("first_seen"),
+                                            transient=touch_data.get("transient"),
+                                            last_seen=touch_data.get("last_seen"))
+            # take a copy of the touches
+            self.active_touches = self.manager.active_touches
+            
+            if self.latency is not None and len(events["events"])>0:
+                touch_data["stamps"]["dispatch"] = wall_clock()
+                self.latency.add(touch_data["stamps"])
+
+            # call the callback
+            if touch_fn is not None and len(events["events"])>0:
+                touch_fn(events["events"])                    
+
+
+class ThreadedZMQTouchHandler(ZMQTouchHandler):
+    """ZMQTouchHandler that receives frames and builds events continuously on
+    a background thread, so slow frames don't delay touch processing.
+
+    Events are buffered until the render thread calls tick(). Each event holds
+    a copy of its Touch taken when the event was built, so timestamps and
+    positions are those of the frame that produced it. If more than max_events
+    are waiting, older DRAG events are dropped (keeping the latest for each
+    touch); DOWN and UP events are never dropped.
+
+    The feedback buffer is written by the render thread, so the worker never reads it: 
+    feedback values (from feedback_buf, or feedback_fn, which may read from GL) 
+    are looked up on the render thread, in tick(), for the events and active touches
+    handed over. Frames are only added to the latency tracer there too."""
+    def __init__(self, zmq_address, feedback_buf, cluster_size=0, feedback_fn=None, wire_format="json",
+                 hwm=None, max_events=1024, latency=None):
+        ZMQTouchHandler.__init__(self, zmq_address, None, cluster_size=cluster_size, 
+                                 wire_format=wire_format, hwm=hwm, latency=latency)
+        self.feedback_buf = feedback_buf
+        self.feedback_fn = feedback_fn
+        self.max_events = max_events
+        self.events_dropped = 0
+        # events and active touches waiting for the render thread
+        self.lock = threading.Lock()
+        self.pending = []
+        self.pending_stamps = [] # latency stamps of the frames in pending
+        self.snapshot = {}
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def compact(self, events):
+        # drop all but the latest DRAG event for each touch
+        last_drag = {}
+        for i, event in enumerate(events):
+            if event.event=="DRAG":
+                last_drag[event.touch.id] = i
+        kept = [event for i, event in enumerate(events) if event.event!="DRAG" or last_drag[event.touch.id]==i]
+        self.events_dropped += len(events)-len(kept)
+        return kept
+
+    def run(self):
+        # worker thread; the socket is only used from here
+        while self.running:
+            if self.socket.poll(timeout=100)==0:
+                continue
+            for touch_data in self.receive():
+                result = self.manager.touch_frame(touch_data["touches"], touch_data["raw"],
+                                                  fseq=touch_data["fseq"], t=touch_data["t"])
+                events = [TouchEvent(event=event.event, touch=copy.copy(event.touch), cluster=copy.copy(event.cluster)) 
+                          for event in result["events"]]
+                snapshot = {slot:copy.copy(touch) for slot, touch in self.manager.active_touches.items()}
+                with self.lock:
+                    if self.latency is not None and len(events)>0:
+                        self.pending_stamps.append(touch_data["stamps"])
+                    self.pending.extend(events)
+                    if len(self.pending)>self.max_events:
+                        self.pending = self.compact(self.pending)
+                    self.snapshot = snapshot
+
+    def tick(self, touch_fn=None):
+        # take all the events built since the last tick, and dispatch them
+        with self.lock:
+            events, self.pending = self.pending, []
+            stamps, self.pending_stamps = self.pending_stamps, []
+            self.active_touches = self.snapshot
+        # the tracer is only used from the render thread
+        for frame_stamps in stamps:
+            frame_stamps["dispatch"] = wall_clock()
+            self.latency.add(frame_stamps)
+        # the snapshot copies belong to this thread once handed over
+        touches = [event.touch for event in events]+list(self.active_touches.values())
+        if len(touches)>0 and self.feedback_fn is not None:
+            # one lookup for every touch, as for ZMQTouchHandler
+            lonlats = np.array([touch.lonlat for touch in touches], dtype=np.float64)
+            for touch, feedback in zip(touches, self.feedback_fn(lonlats)):
+                touch.feedback = feedback
+        elif self.feedback_buf is not None:
+            for touch in touches:
+                touch.feedback = buffer_feedback(self.feedback_buf, touch.lonlat)
+        if touch_fn is not None and len(events)>0:
+            touch_fn(events)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        self.socket.close()
+
+
+def check_expiry():
+    # touches that expire must keep their id and position, in the events
+    # of the frame that expires them and in any references kept by clients
+    manager = TouchManager(linger_time=2.0)
+    down = manager.touch_frame({"1":(0.1, 0.2)}, {"1":(0.5, 0.5)}, fseq=1, t=0.0)["events"][0].touch
+    manager.touch_frame({"1":(0.3, 0.4)}, {"1":(0.6, 0.6)}, fseq=2, t=1.0)
+    # lifted, and already past the linger time
+    up = manager.touch_frame({}, {}, fseq=3, t=3.5)["events"]
+    assert [(e.event, e.touch.id, e.touch.lonlat) for e in up]==[("UP", "1", (0.3, 0.4))]
+    # a new touch reuses the slot
+    manager.touch_frame({"2":(1.0, 1.0)}, {"2":(0.1, 0.1)}, fseq=4, t=4.0)
+    assert down.id=="1" and down.lonlat==(0.3, 0.4) and not down.alive and down.active_touch==0
+    assert manager.touches["2"].active_touch==0 and manager.touches["2"].lonlat==(1.0, 1.0)
+    print("Expiry check passed")
 
 
 if __name__=="__main__":
     touches = [[0,0], [0.1,0], [-0.1, 0], [0,np.pi/4], [0, -np.pi/4], [-1,1], [-1.1, 1]]
-    print np.nonzero(cluster_touches(np.array(touches), 0.2))
+    print cluster_touches(np.array(touches), 0.2)
+    check_expiry()
@@ -1,5 +1,6 @@
 from math import *
 import numpy as np
+from collections import OrderedDict
 from pyspheregl.utils.transformations import quaternion_matrix
 
 def rotate_cartesian(q, v):
@@ -8,6 +9,81 @@ def rotate_cartesian(q, v):
     return v + 2.0 * np.cross(q[0:3], np.cross(q[0:3], v) + q[3]*v)
     
 
+def _pair_args(a, b):
+    # accept either a single (N,2) array, or two (N,) arrays
+    # returns the two columns and the shape of the result
+    if b is None:
+        a = np.asarray(a, dtype=np.float64)
+        return a[...,0], a[...,1], a.shape[:-1]+(2,)
+    a, b = np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64)
+    return a, b, np.broadcast(a, b).shape+(2,)
+
+def _pair_out(shape, out):
+    if out is None:
+        return np.empty(shape, dtype=np.float64)
+    if out.shape!=shape:
+        raise ValueError("Output buffer has shape %s, expected %s" % (out.shape, shape))
+    return out
+
+def np_tuio_to_polar(tuio_x, tuio_y=None, out=None):
+    """Array version of tuio_to_polar. Takes either an (N,2) array of TUIO x,y
+    coordinates, or separate (N,) x and y arrays, and returns an (N,2) array
+    of lon, lat pairs. If out is given, the result is written there
+    (out may be the input array)."""
+    x, y, shape = _pair_args(tuio_x, tuio_y)
+    out = _pair_out(shape, out)
+    lon, lat = out[...,0], out[...,1]
+    np.subtract(x, 0.5, out=lon)
+    lon *= 2*np.pi
+    lon += np.pi
+    np.mod(lon, 2*np.pi, out=lon)
+    lon -= (lon>np.pi) * (2*np.pi)
+    np.subtract(1, y, out=lat)
+    lat *= np.pi
+    lat -= np.pi/2
+    return out
+
+def np_polar_to_tuio(lon, lat=None, out=None):
+    """Array version of polar_to_tuio. Takes either an (N,2) array of lon, lat
+    pairs or separate (N,) lon and lat arrays, and returns an (N,2) array of 
+    TUIO x,y coordinates. If out is given, the result is written there."""
+    lon, lat, shape = _pair_args(lon, lat)
+    out = _pair_out(shape, out)
+    x, y = out[...,0], out[...,1]
+    np.subtract(lon, np.pi, out=x)
+    np.mod(x, 2*np.pi, out=x)
+    x /= 2*np.pi
+    x += 0.5
+    np.add(lat, np.pi/2, out=y)
+    y /= -np.pi
+    y += 1
+    return out
+
+def np_polar_to_display(lon, lat=None, resolution=1200, out=None):
+    """Array version of polar_to_display. Takes either an (N,2) array of lon, lat
+    pairs or separate (N,) lon and lat arrays, and returns an (N,2) array of 
+    pixel coordinates. If out is given, the result is written there."""
+    lon, lat, shape = _pair_args(lon, lat)
+    out = _pair_out(shape, out)
+    w = resolution/2.0
+    # compute these first, so that out can alias the input
+    rw = (np.pi/2-lat) * (w/np.pi)
+    s = np.sin(lon)
+    x, y = out[...,0], out[...,1]
+    np.cos(lon, out=x)
+    x *= rw
+    x += w
+    np.multiply(s, rw, out=y)
+    np.subtract(w, y, out=y)
+    return out
+
+def np_tuio_to_display(tuio_x, tuio_y=None, resolution=1200, out=None):
+    """Array version of tuio_to_display. Takes either an (N,2) array of TUIO x,y
+    coordinates, or separate (N,) x and y arrays, and returns an (N,2) array
+    of pixel coordinates. If out is given, the result is written there."""
+    out = np_tuio_to_polar(tuio_x, tuio_y, out=out)
+    return np_polar_to_display(out, resolution=resolution, out=out)
+
 def tuio_to_display(tuio_x, tuio_y, resolution=1200):
     """tuio_to_polar takes an x/y coordinate given in TUIO format (values 0 to 1)
     where x measures rotation around the equator and y represents to angle between
@@ -16,21 +92,16 @@ def tuio_to_display(tuio_x, tuio_y, resolution=1200):
     Returns Cartesian co-ordinates (i.e. ready to draw onscreen). resolution
     specifies the pixel resolution of the display (must be square).
     """
-    lon, lat = tuio_to_polar(tuio_x, tuio_y)
-    display_x, display_y = polar_to_display(lon, lat, resolution)
-    return display_x, display_y
+    display_x, display_y = np_tuio_to_display(tuio_x, tuio_y, resolution)
+    return float(display_x), float(display_y)
 
 def polar_to_tuio(lon, lat):
     """polar_to_tuio takes a long/lat pair, where long is a value between 0 and 2pi 
     (rotation around the equator) and lat as a value between -pi/2(south pole) and pi/2 (north pole)
     Returns corresponding tuio x,y co-ordinates
     """
-    lon = (lon - np.pi) % (2*np.pi)
-    if lon<0:
-        lon += 2*np.pi
-    x = lon / (2*np.pi) + 0.5
-    y = 1-((lat + (np.pi/2)) / np.pi)    
-    return x, y
+    x, y = np_polar_to_tuio(lon, lat)
+    return float(x), float(y)
 
     
 def tuio_to_polar(tuio_x, tuio_y):
@@ -40,11 +111,8 @@ def tuio_to_polar(tuio_x, tuio_y):
 
     The returns these values as a long/lat pair, where long is a value between 0 and 2pi 
     (rotation around the equator) and lat as a value between -pi/2(south pole) and pi/2 (north pole)"""
-    lon = ((tuio_x-0.5)*2*pi + np.pi) % (2*np.pi)
-    lat = pi * (1-tuio_y) - (pi/2)
-    if lon>np.pi:
-        lon -= 2*np.pi
-    return lon, lat
+    lon, lat = np_tuio_to_polar(tuio_x, tuio_y)
+    return float(lon), float(lat)
     
 
 def az_to_polar(x, y):
@@ -119,10 +187,8 @@ def polar_to_display(lon, lat, resolution=1200):
     specifies the pixel resolution of the display (must be square).
     """
 
-    r = (pi/2-lat)/pi  
-    w = resolution/2
-    x,y = w + r * w * cos(lon), w - r*w*sin(lon)
-    return x,y
+    x, y = np_polar_to_display(lon, lat, resolution)
+    return float(x), float(y)
 
 
 def normalize(x):
@@ -162,6 +228,16 @@ def spherical_distance(p1, p2):
     c = 2*atan2(sqrt(a), sqrt(1-a))    
     return c
 
+def np_spherical_distance_latlon(p1, p2):
+    """Array version of spherical_distance. p1 and p2 are (N,2) arrays 
+    (or anything that broadcasts) of lat, lon, the same order 
+    as spherical_distance. Returns an (N,) array of distances."""
+    p1, p2 = np.asarray(p1, dtype=np.float64), np.asarray(p2, dtype=np.float64)
+    lat1, lon1 = p1[...,0], p1[...,1]
+    lat2, lon2 = p2[...,0], p2[...,1]
+    a = np.sin((lat2-lat1)/2)**2 + np.cos(lat1)*np.cos(lat2)*np.sin((lon2-lon1)/2)**2
+    return 2*np.arctan2(np.sqrt(a), np.sqrt(1-a))
+
 # return initial heading between two points
 def spherical_course(p1, p2):
     """Return the initial heading from point p1 (in radians) to point p2 (in radians)."""   
@@ -297,95 +373,120 @@ def spherical_midpoint(p1, p2):
     
 
 
+def _lonlat_to_unit(pts):
+    # (N,2) lon, lat to (N,3) unit vectors, using the same 
+    # convention as spherical_to_cartesian (and the shaders)
+    pts = np.asarray(pts, dtype=np.float64).reshape(-1, 2)
+    lon, lat = pts[:,0], pts[:,1]
+    cos_lat = np.cos(lat)
+    cart = np.empty((len(pts), 3))
+    cart[:,0] = np.cos(lon) * cos_lat
+    cart[:,1] = np.sin(lon) * cos_lat
+    cart[:,2] = np.sin(lat)
+    return cart
+
+def _unit_to_lonlat(cart):
+    # inverse of _lonlat_to_unit; returns float32 (N,2) lon, lat
+    lonlat = np.empty((len(cart), 2), dtype=np.float32)
+    lonlat[:,0] = np.arctan2(cart[:,1], cart[:,0])
+    lonlat[:,1] = np.arctan2(cart[:,2], np.hypot(cart[:,0], cart[:,1]))
+    return lonlat
+
+def _as_uv(uv):
+    if uv is None:
+        return None
+    return np.asarray(uv, dtype=np.float64).reshape(-1, 2)
+
+def _edge_midpoints(cart, uv, edges):
+    """Add the great circle midpoint of each of the (E,2) vertex index
+    pairs in edges. Edges are hashed on their (sorted) vertex indices, 
+    so an edge shared between faces gets a single midpoint vertex.
+    Returns the new vertices, uvs, and the (E,) index of each edge's midpoint."""
+    n = len(cart)
+    lo, hi = np.minimum(edges[:,0], edges[:,1]), np.maximum(edges[:,0], edges[:,1])
+    keys = lo.astype(np.int64) * n + hi
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    a, b = lo[first], hi[first]
+    # midpoint of the great circle arc is the normalised chord midpoint
+    mid = cart[a] + cart[b]
+    mid /= np.sqrt(np.sum(mid*mid, axis=1))[:,None]
+    cart = np.vstack((cart, mid))
+    if uv is not None:
+        uv = np.vstack((uv, 0.5*(uv[a]+uv[b])))
+    return cart, uv, n + inverse.reshape(-1)
+
+def _subdivide_triangles(cart, faces, uv):
+    f0, f1, f2 = faces[:,0], faces[:,1], faces[:,2]
+    edges = np.concatenate((faces[:,[0,1]], faces[:,[1,2]], faces[:,[2,0]]))
+    cart, uv, mids = _edge_midpoints(cart, uv, edges)
+    m1, m2, m3 = mids.reshape(3, -1)
+    newfaces = np.array([[m3, m1, m2], 
+                         [m3, f0, m1],
+                         [m2, m1, f1],
+                         [f2, m3, m2]])
+    # reorder so the four new faces of each face are consecutive
+    return cart, newfaces.transpose(2, 0, 1).reshape(-1, 3), uv
+
+def _subdivide_quads(cart, faces, uv):
+    f0, f1, f2, f3 = faces[:,0], faces[:,1], faces[:,2], faces[:,3]
+    edges = np.concatenate((faces[:,[0,1]], faces[:,[1,2]], faces[:,[2,3]], faces[:,[3,0]]))
+    cart, uv, mids = _edge_midpoints(cart, uv, edges)
+    m1, m2, m3, m4 = mids.reshape(4, -1)
+    # the centre is the midpoint of the two side midpoints
+    cart, uv, c = _edge_midpoints(cart, uv, np.stack((m2, m4), axis=1))
+    newfaces = np.array([[f0, m1, c, m4], 
+                         [m1, f1, m2, c],
+                         [c, m2, f2, m3],
+                         [m4, c, m3, f3]])
+    return cart, newfaces.transpose(2, 0, 1).reshape(-1, 4), uv
+
+def _spherical_mesh_cart(subdivide, cart, faces, uv, iter):
+    # run iter subdivisions on unit vectors
+    uv = _as_uv(uv)
+    faces = np.asarray(faces, dtype=np.int64)
+    for i in range(iter):
+        cart, faces, uv = subdivide(cart, faces, uv)
+    if uv is not None:
+        uv = uv.astype(np.float32)
+    return cart, faces.astype(np.uint32), uv
+
+def _spherical_mesh(subdivide, vertices, faces, uv, iter):
+    # run iter subdivisions in Cartesian space, converting only at the ends
+    cart, faces, uv = _spherical_mesh_cart(subdivide, _lonlat_to_unit(vertices), faces, uv, iter)
+    return _unit_to_lonlat(cart), faces, uv
+
 def subdivide_spherical_triangles(vertices, faces, uv=None):
-    # should also generate UV co-ordinates...
-    newfaces = []
-    vertices = list(vertices)
-    def midpoint(p1, p2):
-        return ((p1[0]+p2[0])/2,(p1[1]+p2[1])/2)
-        
-    for face in faces:        
-        v1 = spherical_midpoint(vertices[face[0]],vertices[face[1]])
-        v2 = spherical_midpoint(vertices[face[1]],vertices[face[2]])
-        v3 = spherical_midpoint(vertices[face[2]],vertices[face[0]])        
-        
-        if uv:
-            uv1 = midpoint(uv[face[0]], uv[face[1]])
-            uv2 = midpoint(uv[face[1]], uv[face[2]])
-            uv3 = midpoint(uv[face[2]], uv[face[0]])
-            uv += [uv1,uv2,uv3]
-            
-        
-        vindex1 = len(vertices)
-        vindex2 = len(vertices)+1
-        vindex3 = len(vertices)+2
-        vertices += [v1,v2,v3]
-        
-        # new face
-        newfaces.append((vindex3, vindex1, vindex2))        
-        newfaces.append((vindex3, face[0], vindex1))
-        newfaces.append((vindex2, vindex1, face[1]))
-        newfaces.append((face[2],vindex3,  vindex2))
-    return vertices, newfaces, uv
+    """Split each spherical triangle into four, at the great circle midpoints of 
+    its edges. Midpoints of shared edges are only created once. UV coordinates 
+    (if given) are interpolated linearly.
+
+    Returns (vertices, faces, uv) as an (N,2) float32 array of lon, lat, an (M,3) uint32
+    array of indices and an (N,2) float32 array of UVs (or None)."""
+    return _spherical_mesh(_subdivide_triangles, vertices, faces, uv, 1)
     
 def subdivide_spherical_quads(vertices, faces, uv=None):
-    # should also generate UV co-ordinates...
-    newfaces = []
-    vertices = list(vertices)
-    def midpoint(p1, p2):
-        return ((p1[0]+p2[0])/2,(p1[1]+p2[1])/2)
-        
-    for face in faces:        
-        v1 = spherical_midpoint(vertices[face[0]],vertices[face[1]])
-        v2 = spherical_midpoint(vertices[face[1]],vertices[face[2]])
-        v3 = spherical_midpoint(vertices[face[2]],vertices[face[3]])        
-        v4 = spherical_midpoint(vertices[face[3]],vertices[face[0]])        
-        v7 = spherical_midpoint(v2,v4)
-        
-        if uv:            
-            uv1 = midpoint(uv[face[0]], uv[face[1]])
-            uv2 = midpoint(uv[face[1]], uv[face[2]])
-            uv3 = midpoint(uv[face[2]], uv[face[3]])
-            uv4 = midpoint(uv[face[3]], uv[face[0]])            
-            uv5 = midpoint(uv4, uv2)
-            uv += [uv1,uv2,uv3, uv4, uv5]
-            
-        
-        vindex1 = len(vertices)
-        vindex2 = len(vertices)+1
-        vindex3 = len(vertices)+2
-        vindex4 = len(vertices)+3
-        vindex5 = len(vertices)+4
-        vertices += [v1,v2,v3,v4,v7]
-        
-        # new face
-        newfaces.append((face[0], vindex1, vindex5, vindex4))        
-        newfaces.append((vindex1, face[1], vindex2, vindex5))        
-        newfaces.append((vindex5, vindex2, face[2], vindex3))        
-        newfaces.append((vindex4, vindex5, vindex3, face[3]))        
-    
-    return vertices, newfaces, uv
+    """Split each spherical quad into four, at the great circle midpoints of 
+    its edges. Midpoints of shared edges are only created once. UV coordinates 
+    (if given) are interpolated linearly.
+
+    Returns (vertices, faces, uv) as an (N,2) float32 array of lon, lat, an (M,4) uint32
+    array of indices and an (N,2) float32 array of UVs (or None)."""
+    return _spherical_mesh(_subdivide_quads, vertices, faces, uv, 1)
     
 def spherical_triangle(pts,uv=None,iter=2):
     """Return a triangle mesh for the triangle given by pts (in (lon,lat) pair form).
-    Triangle is subdivied iter times; don't use more than 3 or 4!
+    Triangle is subdivided iter times, giving 4**iter triangles.
+    Returns (vertices, faces, uv) arrays, as subdivide_spherical_triangles.
     """
-    vertices = pts
-    faces = [[0,1,2]]
-    for i in range(iter):
-        vertices, faces,uv = subdivide_spherical_triangles(vertices, faces, uv)
-    return vertices, faces, uv
+    return _spherical_mesh(_subdivide_triangles, pts, [[0,1,2]], uv, iter)
    
 
 def spherical_quad(pts, iter=2, uv=None, **kwargs):
     """Return a quad mesh for the quadrilateral given by pts (in (lon,lat) pair form).
-    Triangle is subdivied iter times; don't use more than 3 or 4!
+    Quad is subdivided iter times, giving 4**iter quads on (2**iter+1)**2 vertices.
+    Returns (vertices, faces, uv) arrays, as subdivide_spherical_quads.
     """    
-    vertices = pts
-    faces = [[0,1,2,3]]    
-    for i in range(iter):
-        vertices, faces, uv = subdivide_spherical_quads(vertices, faces, uv)
-    return vertices, faces, uv
+    return _spherical_mesh(_subdivide_quads, pts, [[0,1,2,3]], uv, iter)
    
    
 import numpy as np
@@ -393,7 +494,8 @@ import numpy as np
 def spherical_to_cartesian(pt):
     """Convert a lon, lat co-ordinate to an a Cartesian x,y,z point on the unit sphere."""
     lon, lat = pt 
-    lat += np.pi/2
+    # not +=, which would modify array arguments in place
+    lat = lat + np.pi/2
     st = np.sin(lat)
     x = np.cos(lon) * st
     y = np.sin(lon) * st
@@ -434,6 +536,15 @@ def cartesian_to_spherical(pt):
 
 def cart_to_polar(x,y,z):
     return cartesian_to_spherical([x,y,z])
+
+def np_cartesian_to_spherical(pts):
+    """Array version of cartesian_to_spherical. Takes an (N,3) array
+    of Cartesian points, and returns (N,) arrays of lon and lat."""
+    pts = np.asarray(pts, dtype=np.float64)
+    n = np.sqrt(np.sum(pts*pts, axis=1))
+    lat = np.arccos(pts[:,2] / n) - np.pi/2
+    lon = np.arctan2(pts[:,1], pts[:,0])
+    return lon, lat
     
 def tangent_coord_system(origin, up_point):
     """Given a pair of points in Cartesian co-ordinates on a unit sphere,
@@ -494,5 +605,84 @@ def spherical_rectangle(centre, width, height, up, x_ratio=1, y_ratio=1, **kwarg
     
     uv = [[0.0,0.0], [x_ratio,0.0], [x_ratio,y_ratio], [0.0,y_ratio]]
     return spherical_quad(pts, uv=uv, **kwargs)
-    
-     
+
+
+def _canonical_rectangle(width, height, x_ratio, y_ratio, iter):
+    # spherical_rectangle as unit vectors in a fixed tangent frame:
+    # centre on the x axis, right along y, up along z
+    corners = np.array([[1.0, -width, -height], 
+                        [1.0, width, -height], 
+                        [1.0, width, height], 
+                        [1.0, -width, height]])
+    corners /= np.sqrt(np.sum(corners*corners, axis=1))[:,None]
+    uv = [[0.0,0.0], [x_ratio,0.0], [x_ratio,y_ratio], [0.0,y_ratio]]
+    return _spherical_mesh_cart(_subdivide_quads, corners, [[0,1,2,3]], uv, iter)
+
+class SphericalMeshCache(object):
+    """Bounded LRU cache of spherical rectangle and quad meshes.
+
+    Rectangles are cached once per (width, height, iter, x_ratio, y_ratio), 
+    in a canonical tangent frame, and only rotated into place on each call. 
+    Quads are cached by their exact corner points.
+    hits and misses count lookups, to help choose max_size.
+    
+    The returned face and uv arrays are shared between calls, and are read-only."""
+    def __init__(self, max_size=64):
+        self.max_size = max_size
+        self.meshes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, key, make_mesh):
+        mesh = self.meshes.pop(key, None)
+        if mesh is None:
+            self.misses += 1
+            mesh = make_mesh()
+            for arr in mesh:
+                if arr is not None:
+                    arr.flags.writeable = False
+        else:
+            self.hits += 1
+        # (re)insert as most recently used, and evict the oldest
+        self.meshes[key] = mesh
+        while len(self.meshes)>self.max_size:
+            self.meshes.popitem(last=False)
+        return mesh
+
+    def clear(self):
+        self.meshes.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def rectangle(self, centre, width, height, up, x_ratio=1, y_ratio=1, iter=2):
+        """As spherical_rectangle, but using the cached mesh"""
+        key = ("rectangle", float(width), float(height), iter, float(x_ratio), float(y_ratio))
+        cart, faces, uv = self._lookup(key, lambda: _canonical_rectangle(width, height, x_ratio, y_ratio, iter))
+        
+        # rotate the canonical frame onto the tangent frame at centre
+        orig = np.array(spherical_to_cartesian(centre))
+        upv = np.array(spherical_to_cartesian(up))
+        up, right, forward = tangent_coord_system(orig, upv)
+        vertices = _unit_to_lonlat(np.dot(cart, np.array([forward, right, up])))
+        # spherical_rectangle goes back to spherical with cartesian_to_spherical,
+        # which flips the sign of latitude
+        vertices[:,1] = -vertices[:,1]
+        return vertices, faces, uv
+
+    def quad(self, pts, iter=2, uv=None):
+        """As spherical_quad, but using the cached mesh. The result is read-only."""
+        key = ("quad", tuple(np.asarray(pts, dtype=np.float64).ravel()), iter, 
+               None if uv is None else tuple(np.asarray(uv, dtype=np.float64).ravel()))
+        return self._lookup(key, lambda: spherical_quad(pts, iter=iter, uv=uv))
+
+# shared cache used by cached_spherical_rectangle and cached_spherical_quad
+mesh_cache = SphericalMeshCache()
+
+def cached_spherical_rectangle(centre, width, height, up, x_ratio=1, y_ratio=1, iter=2):
+    """Return the same mesh as spherical_rectangle, using the shared mesh_cache.
+    Repeated (width, height, iter, ratio) combinations only pay for a rotation."""
+    return mesh_cache.rectangle(centre, width, height, up, x_ratio=x_ratio, y_ratio=y_ratio, iter=iter)
+
+def cached_spherical_quad(pts, iter=2, uv=None):
+    """Return the same mesh as spherical_quad, using the shared mesh_cache."""
+    return mesh_cache.quad(pts, iter=iter, uv=uv)
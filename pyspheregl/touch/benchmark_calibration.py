@@ -0,0 +1,76 @@
+"""Compare the row-by-row and vectorized calibration preprocessing
+on a synthetic calibration set.
+
+Usage: python -m pyspheregl.touch.benchmark_calibration [--n N] [--n_train N_TRAIN] [--n_error N_ERROR]
+"""
+import timeit
+import numpy as np
+import pandas as pd
+import fire
+from ..sphere import sphere
+from . import touch_calibration as tc
+
+def synthetic_calibration(n, seed=0):
+    """Return a calibration DataFrame with n rows, where the touches
+    are smoothly distorted versions of the targets"""
+    rand = np.random.RandomState(seed)
+    tuio_x = rand.uniform(0.02, 0.98, n)
+    tuio_y = rand.uniform(0.02, 0.8, n)
+    distorted_x = tuio_x + 0.01*np.sin(tuio_y*6) + rand.normal(0, 0.002, n)
+    distorted_y = tuio_y + 0.01*np.cos(tuio_x*5) + rand.normal(0, 0.002, n)
+    targets = sphere.np_tuio_to_polar(distorted_x, distorted_y)
+    return pd.DataFrame({"target_lon":targets[:,0], "target_lat":targets[:,1],
+                         "tuio_x":tuio_x, "tuio_y":tuio_y})
+
+# the original, row-at-a-time implementations
+def rowwise_augment(calibration):
+    xs, ys = calibration["tuio_x"], calibration["tuio_y"]
+    lonlat = np.array([sphere.tuio_to_polar(x,y) for x,y in zip(xs,ys)])
+    calibration["touch_lon"],calibration["touch_lat"] = lonlat[:,0], lonlat[:,1]
+    calibration["target_lon"] = tc.fix_angle(calibration["target_lon"])
+    calibration["touch_lon"] = tc.fix_angle(calibration["touch_lon"])
+
+def rowwise_distances(calibration):
+    return [sphere.spherical_distance((r["target_lon"], r["target_lat"]),
+                                      (r["touch_lon"], r["touch_lat"])) for ix, r in calibration.iterrows()]
+
+def rowwise_error_distribution(calibration, gp):
+    ds = []
+    for ix, row in calibration.iterrows():
+        lonc, latc = tc.gp_adjust(row["touch_lon"], row["touch_lat"], gp)
+        ds.append(np.degrees(sphere.spherical_distance((row["target_lon"], row["target_lat"]), (lonc, latc))))
+    return ds
+
+def timed(fn):
+    start = timeit.default_timer()
+    result = fn()
+    return timeit.default_timer()-start, result
+
+def report(name, t_old, t_new, max_diff):
+    print("%-20s row-wise %8.3fs   vectorized %8.4fs   speedup %7.1fx   max diff %.2g" %
+          (name, t_old, t_new, t_old/max(t_new, 1e-9), max_diff))
+
+def benchmark(n=10000, n_train=500, n_error=None):
+    """Run the benchmark on n synthetic rows. The GP for the error distribution is
+    trained on the first n_train rows, and the row-wise error distribution is only
+    evaluated on the first n_error rows (default: all n), as it is very slow."""
+    print("Synthetic calibration with %d rows" % n)
+    old, new = synthetic_calibration(n), synthetic_calibration(n)
+
+    t_old, _ = timed(lambda: rowwise_augment(old))
+    t_new, _ = timed(lambda: tc.augment_calibration(new))
+    report("augment", t_old, t_new, np.max(np.abs(old[["touch_lon", "touch_lat"]].values -
+                                                   new[["touch_lon", "touch_lat"]].values)))
+
+    t_old, d_old = timed(lambda: rowwise_distances(old))
+    t_new, d_new = timed(lambda: tc.calibration_distances(new))
+    report("distances", t_old, t_new, np.max(np.abs(np.array(d_old)-d_new)))
+
+    gp = tc.train_gp(new[:n_train], alpha=tc.CALIBRATION_NOISE_LEVEL)
+    subset = new if n_error is None else new[:n_error]
+    t_old, e_old = timed(lambda: rowwise_error_distribution(subset, gp))
+    t_new, e_new = timed(lambda: tc.error_distribution(subset, lambda lon, lat: tc.gp_adjust_many(lon, lat, gp)))
+    report("error_distribution", t_old, t_new, np.max(np.abs(np.array(e_old)-e_new)))
+
+if __name__=="__main__":
+    fire.Fire(benchmark)
@@ -2,40 +2,387 @@ import pandas as pd
 import timeit
 import numpy as np
 import pickle
-import os, sys, time, random
-from sklearn import gaussian_process
+import hashlib
+import os, sys, time, random, glob
+import copy
+import threading
+import collections
+import Queue
 from ..sphere import sphere
 
-def train_gp(calibration, alpha=1e-2):
+def calibration_cartesian(calibration):
+    """Return the touches and targets of a calibration as (N,3) Cartesian arrays"""
+    tx, ty, tz = sphere.spherical_to_cartesian((calibration["target_lon"].values, calibration["target_lat"].values))
+    x,y,z = sphere.spherical_to_cartesian((calibration["touch_lon"].values, 
+                                            calibration["touch_lat"].values))    
+    return np.vstack((x,y,z)).T, np.vstack((tx, ty, tz)).T
+
+def rbf_kernel(a, b, length_scale=1.0):
+    """Squared-exponential kernel matrix between the rows of a and b 
+    (the same as sklearn's default GP kernel)"""
+    d2 = np.sum(a*a, axis=1)[:,None] + np.sum(b*b, axis=1)[None,:] - 2*np.dot(a, b.T)
+    return np.exp(-0.5*np.maximum(d2, 0)/length_scale**2)
+
+class ApproximateGP(object):
+    """Low-rank approximation to a zero-mean GP with an RBF kernel, 
+    with the same fit/predict interface as sklearn's GaussianProcessRegressor.
+
+    method="nystrom" uses rank inducing points chosen from the training inputs
+    (subset of regressors); method="rff" uses rank random Fourier features.
+    Training is O(n rank^2) and prediction O(rank) per point."""
+    def __init__(self, alpha=1e-2, method="nystrom", rank=200, length_scale=1.0, seed=0):
+        if method not in ("nystrom", "rff"):
+            raise CalibrationException("Approximate GP method must be 'nystrom' or 'rff'")
+        self.alpha = alpha
+        self.method = method
+        self.rank = rank
+        self.length_scale = length_scale
+        self.seed = seed
+
+    def features(self, x):
+        """Map (N,3) inputs to the (N,rank) feature space"""
+        if self.method=="nystrom":
+            return rbf_kernel(x, self.inducing, self.length_scale)
+        return np.sqrt(2.0/self.rank) * np.cos(np.dot(x, self.w) + self.b)
+
+    def residual(self, x, y):
+        # the value the features are fitted to
+        return y
+
+    def linear_system(self, x, y):
+        """Return the normal equations (A, B) for the weights, A weights = B"""
+        phi = self.features(x)
+        if self.method=="nystrom":
+            k_mm = rbf_kernel(self.inducing, self.inducing, self.length_scale)
+        else:
+            k_mm = np.eye(self.rank)
+        a = np.dot(phi.T, phi) + self.alpha*k_mm
+        # small jitter keeps the solve stable if inducing points nearly coincide
+        a += 1e-10 * np.trace(a)/len(a) * np.eye(len(a))
+        return a, np.dot(phi.T, self.residual(x, y))
+
+    def fit(self, x, y):
+        rand = np.random.RandomState(self.seed)
+        if self.method=="nystrom":
+            ixs = rand.choice(len(x), min(self.rank, len(x)), replace=False)
+            self.inducing = x[ixs]
+        else:
+            self.w = rand.normal(0, 1.0/self.length_scale, (x.shape[1], self.rank))
+            self.b = rand.uniform(0, 2*np.pi, self.rank)
+        self.weights = np.linalg.solve(*self.linear_system(x, y))
+        return self
+
+    def predict(self, x):
+        return np.dot(self.features(np.asarray(x, dtype=np.float64)), self.weights)
+
+def train_gp(calibration, alpha=1e-2, approximate=None, rank=200):
     """Train a squared-exponential Gaussian process to predict offsets
     in azimuthal equidistant space. The GPs are trained on x, y, z inputs in the
     cartesian space, and predict x' and y' outputs.
+
+    approximate can be "nystrom" or "rff" to train an ApproximateGP 
+    of the given rank instead of the exact GP, for large calibration sets.
     
     Returns a GP object that performs the prediction."""
-    unique_targets = calibration.copy()
-    tx, ty, tz = sphere.spherical_to_cartesian((unique_targets["target_lon"], unique_targets["target_lat"]))
-    x,y,z = sphere.spherical_to_cartesian((unique_targets["touch_lon"], 
-                                            unique_targets["touch_lat"]))    
-    target = np.vstack((x,y,z)).transpose()       
-    residual = np.vstack((tx, ty, tz)).T
+    target, residual = calibration_cartesian(calibration)
+    if approximate is not None:
+        return ApproximateGP(alpha=alpha, method=approximate, rank=rank).fit(target, residual)
+    # sklearn is slow to import, so only load it if a GP is used
+    from sklearn import gaussian_process
     gp = gaussian_process.GaussianProcessRegressor(alpha=alpha)
     gp.fit(target, residual)
     return gp
-
         
 def gp_adjust(lon, lat, gp):
-    x,y,z = sphere.spherical_to_cartesian((lon, lat))
-    res = gp.predict([[x,y,z]])
-    xc, yc, zc = res[0]
-    corr_touch_lon, corr_touch_lat = sphere.cart_to_polar(xc, yc, zc)
-    return corr_touch_lon, corr_touch_lat
+    corr_touch_lon, corr_touch_lat = gp_adjust_many(np.array([lon]), np.array([lat]), gp)
+    return corr_touch_lon[0], corr_touch_lat[0]
+
+def gp_adjust_many(lon, lat, gp):
+    """Adjust arrays of lon, lat touch points with a single GP prediction.
+    Returns the corrected lon, lat arrays."""
+    x,y,z = sphere.spherical_to_cartesian((np.asarray(lon, dtype=np.float64), 
+                                           np.asarray(lat, dtype=np.float64)))
+    res = gp.predict(np.stack((x,y,z), axis=1))
+    return sphere.np_cartesian_to_spherical(res)
+
+def gp_predict(gp, pts, chunk=8192):
+    # predict in chunks, so that the kernel matrix 
+    # for large batches does not exhaust memory
+    return np.concatenate([gp.predict(pts[i:i+chunk]) for i in range(0, len(pts), chunk)])
+
+def _unit_angle(a, b):
+    # angle between the rows of two (N,3) arrays, in radians
+    a = a / np.linalg.norm(a, axis=1)[:,None]
+    b = b / np.linalg.norm(b, axis=1)[:,None]
+    return np.arctan2(np.linalg.norm(np.cross(a, b), axis=1), np.sum(a*b, axis=1))
+
+def _cubic_weights(t):
+    # Catmull-Rom weights for the four neighbouring samples
+    t2, t3 = t*t, t*t*t
+    return (0.5*(-t3 + 2*t2 - t), 
+            0.5*(3*t3 - 5*t2 + 2),
+            0.5*(-3*t3 + 4*t2 + t),
+            0.5*(t3 - t2))
+
+class CorrectionGrid(object):
+    """Precomputed calibration correction over TUIO x,y space.
+
+    The grid stores the corrected Cartesian point for each of 
+    (resolution+1)x(resolution+1) evenly spaced TUIO co-ordinates, 
+    so a lookup costs the same regardless of the model size.
+    order=1 uses bilinear interpolation, order=3 uses bicubic (Catmull-Rom)."""
+    def __init__(self, grid, order=1):
+        if order not in (1, 3):
+            raise CalibrationException("Correction grid order must be 1 (bilinear) or 3 (bicubic)")
+        self.grid = np.ascontiguousarray(grid, dtype=np.float64)
+        self.resolution = self.grid.shape[0] - 1
+        self.order = order
+        self.max_error = None
+        self.mean_error = None
+
+    @staticmethod
+    def sample_points(resolution):
+        """Return the (resolution+1)**2 TUIO co-ordinates of the grid nodes, as (N,2)"""
+        t = np.linspace(0, 1, resolution+1)
+        ys, xs = np.meshgrid(t, t, indexing="ij")
+        return np.stack((xs.ravel(), ys.ravel()), axis=1)
+
+    @classmethod
+    def from_model(cls, predict, resolution=256, order=1):
+        """Build a grid by evaluating predict, which maps an (N,3) array
+        of raw Cartesian touch points to corrected Cartesian points"""
+        lonlat = sphere.np_tuio_to_polar(cls.sample_points(resolution))
+        x,y,z = sphere.spherical_to_cartesian((lonlat[:,0], lonlat[:,1]))
+        grid = predict(np.stack((x,y,z), axis=1))
+        return cls(grid.reshape(resolution+1, resolution+1, 3), order=order)
+
+    def lookup_cartesian(self, xs, ys):
+        """Interpolate the corrected Cartesian points (N,3) for 
+        TUIO co-ordinates xs, ys"""
+        r = self.resolution
+        gx = np.clip(np.asarray(xs, dtype=np.float64), 0, 1) * r
+        gy = np.clip(np.asarray(ys, dtype=np.float64), 0, 1) * r
+        ix = np.minimum(gx.astype(np.int64), r-1)
+        iy = np.minimum(gy.astype(np.int64), r-1)
+        fx, fy = (gx-ix)[:,None], (gy-iy)[:,None]
+        g = self.grid
+        if self.order==1:
+            top = g[iy, ix] * (1-fx) + g[iy, ix+1] * fx
+            bottom = g[iy+1, ix] * (1-fx) + g[iy+1, ix+1] * fx
+            return top * (1-fy) + bottom * fy
+        # bicubic; x wraps around (column r is the same meridian as column 0)
+        # and y is clamped at the poles
+        wx, wy = _cubic_weights(fx), _cubic_weights(fy)
+        out = np.zeros((len(ix), 3))
+        for j in range(4):
+            row = np.clip(iy+j-1, 0, r)
+            acc = np.zeros((len(ix), 3))
+            for i in range(4):
+                acc += g[row, (ix+i-1) % r] * wx[i]
+            out += acc * wy[j]
+        return out
+
+    def lookup(self, xs, ys):
+        """Return the corrected lon, lat (as an (N,2) array) for TUIO co-ordinates xs, ys"""
+        lon, lat = sphere.np_cartesian_to_spherical(self.lookup_cartesian(xs, ys))
+        return np.stack((lon, lat), axis=1)
+
+    def measure_error(self, predict, n=4096, seed=0):
+        """Compare the grid against the exact model at n random TUIO points. 
+        Sets and returns the max and mean deviation, in degrees."""
+        pts = np.random.RandomState(seed).uniform(0, 1, (n, 2))
+        lonlat = sphere.np_tuio_to_polar(pts)
+        x,y,z = sphere.spherical_to_cartesian((lonlat[:,0], lonlat[:,1]))
+        exact = predict(np.stack((x,y,z), axis=1))
+        d = np.degrees(_unit_angle(exact, self.lookup_cartesian(pts[:,0], pts[:,1])))
+        self.max_error, self.mean_error = float(np.max(d)), float(np.mean(d))
+        return self.max_error, self.mean_error
+
+    def save(self, fname):
+        np.savez(fname, grid=self.grid, order=self.order, 
+                 max_error=np.nan if self.max_error is None else self.max_error,
+                 mean_error=np.nan if self.mean_error is None else self.mean_error)
+
+    @classmethod
+    def load(cls, fname):
+        data = np.load(fname)
+        grid = cls(data["grid"], order=int(data["order"]))
+        if np.isfinite(data["max_error"]):
+            grid.max_error, grid.mean_error = float(data["max_error"]), float(data["mean_error"])
+        return grid
+
+def grid_fname(calibration_name, resolution, order, training_key=""):
+    """Name of the correction grid file stored alongside a calibration CSV.
+    training_key identifies everything the fit depends on (see training_key())"""
+    base = os.path.splitext(calibration_name)[0]
+    return "%s_grid_%d_%d_%s.npz" % (base, resolution, order, training_key)
+
+def training_key(csv_path, exclude_distance, model_tag):
+    """Short hash of the calibration CSV contents and the training parameters"""
+    h = hashlib.sha1()
+    h.update(repr((exclude_distance, model_tag)))
+    with open(csv_path, "rb") as f:
+        h.update(f.read())
+    return h.hexdigest()[:16]
+
+CALIBRATION_NOISE_LEVEL = 1e-2
+
+class GPModel(object):
+    """Calibration model using a Gaussian process (see train_gp)"""
+    name = "gp"
+    def __init__(self, alpha=CALIBRATION_NOISE_LEVEL, approximate=None, rank=200):
+        self.alpha = alpha
+        self.approximate = approximate
+        self.rank = rank
+        self.gp = None
+
+    def params(self):
+        if self.approximate is not None:
+            return {"alpha":self.alpha, "approximate":self.approximate, "rank":self.rank}
+        import sklearn
+        return {"alpha":self.alpha, "sklearn":sklearn.__version__}
+
+    def fit(self, calibration):
+        self.gp = train_gp(calibration, alpha=self.alpha, approximate=self.approximate, rank=self.rank)
+        return self
+
+    def predict(self, pts):
+        return gp_predict(self.gp, pts)
+
+
+def real_spherical_harmonics(pts, degree):
+    """Evaluate the real spherical harmonics up to the given degree at the 
+    (N,3) unit vectors pts. Returns an (N, (degree+1)**2) array, ordered 
+    by degree l and then order m=0, 1(cos), 1(sin), 2(cos), 2(sin) ..."""
+    pts = np.asarray(pts, dtype=np.float64)
+    z = np.clip(pts[:,2], -1, 1)
+    s = np.sqrt(1-z*z)
+    phi = np.arctan2(pts[:,1], pts[:,0])
+    out = np.empty((len(pts), (degree+1)**2))
+    pmm = np.ones_like(z)
+    for m in range(degree+1):
+        if m>0:
+            pmm = pmm * (2*m-1) * s
+        # associated Legendre polynomials P_l^m, l=m..degree
+        p_prev, p = None, pmm
+        for l in range(m, degree+1):
+            if l==m+1:
+                p_prev, p = p, z*(2*m+1)*pmm
+            elif l>m+1:
+                p_prev, p = p, ((2*l-1)*z*p - (l+m-1)*p_prev)/(l-m)
+            k = np.sqrt((2*l+1)/(4*np.pi) * np.exp(gammaln(l-m+1)-gammaln(l+m+1)))
+            if m==0:
+                out[:,l*l] = k*p
+            else:
+                out[:,l*l+2*m-1] = np.sqrt(2)*k*p*np.cos(m*phi)
+                out[:,l*l+2*m] = np.sqrt(2)*k*p*np.sin(m*phi)
+    return out
+
+def gammaln(n):
+    # log(Gamma(n)) for positive integers
+    return np.sum(np.log(np.arange(1, n)))
+
+class HarmonicModel(object):
+    """Calibration model predicting the Cartesian displacement of each touch
+    as a linear combination of real spherical harmonics up to degree. 
+    The (degree+1)**2 x 3 coefficients are fitted by regularised least squares."""
+    name = "harmonic"
+    def __init__(self, degree=6, regularisation=1e-6):
+        self.degree = degree
+        self.regularisation = regularisation
+        self.weights = None
+
+    def params(self):
+        return {"degree":self.degree, "regularisation":self.regularisation}
+
+    def features(self, pts):
+        return real_spherical_harmonics(pts, self.degree)
+
+    def residual(self, pts, target):
+        # the harmonics model the displacement from the touch
+        return target - pts
+
+    def linear_system(self, touch, target):
+        """Return the normal equations (A, B) for the weights, A weights = B"""
+        a = self.features(touch)
+        return (np.dot(a.T, a) + self.regularisation*len(a)*np.eye(a.shape[1]), 
+                np.dot(a.T, self.residual(touch, target)))
+
+    def fit(self, calibration):
+        touch, target = calibration_cartesian(calibration)
+        n = (self.degree+1)**2
+        if len(touch)<n:
+            raise CalibrationException("Need at least %d targets for a degree %d harmonic model" % (n, self.degree))
+        self.weights = np.linalg.solve(*self.linear_system(touch, target))
+        return self
+
+    def predict(self, pts):
+        pts = np.asarray(pts, dtype=np.float64)
+        return pts + np.dot(self.features(pts), self.weights)
+
+    def glsl(self, name="calibrate"):
+        """Return GLSL source for a function vec3 name(vec3 p) that applies 
+        the model to a unit vector p (the result is not normalised)"""
+        n = (self.degree+1)**2
+        coeffs = ",\n    ".join(["vec3(%.9g, %.9g, %.9g)" % tuple(c) for c in self.weights])
+        k = []
+        for l in range(self.degree+1):
+            for m in range(l+1):
+                k.append(np.sqrt((2*l+1)/(4*np.pi) * np.exp(gammaln(l-m+1)-gammaln(l+m+1))) * (1 if m==0 else np.sqrt(2)))
+        norms = ", ".join(["%.9g" % v for v in k])
+        return """const int %(name)s_degree = %(degree)d;
+const vec3 %(name)s_coeffs[%(n)d] = vec3[%(n)d](
+    %(coeffs)s);
+const float %(name)s_norms[%(n_norms)d] = float[%(n_norms)d](%(norms)s);
+
+vec3 %(name)s(vec3 p)
+{
+    float z = clamp(p.z, -1.0, 1.0);
+    float s = sqrt(1.0-z*z);
+    float phi = atan(p.y, p.x);
+    vec3 d = vec3(0.0);
+    float pmm = 1.0;
+    for(int m=0; m<=%(name)s_degree; m++)
+    {
+        if(m>0) pmm *= float(2*m-1) * s;
+        float p_prev = 0.0, p_l = pmm;
+        for(int l=m; l<=%(name)s_degree; l++)
+        {
+            if(l==m+1) { p_prev = p_l; p_l = z*float(2*m+1)*pmm; }
+            else if(l>m+1) { float t = (float(2*l-1)*z*p_l - float(l+m-1)*p_prev)/float(l-m); p_prev = p_l; p_l = t; }
+            // norms are stored ordered by l, then m
+            float k = %(name)s_norms[l*(l+1)/2+m] * p_l;
+            if(m==0)
+                d += k * %(name)s_coeffs[l*l];
+            else
+                d += k * (cos(float(m)*phi) * %(name)s_coeffs[l*l+2*m-1] + sin(float(m)*phi) * %(name)s_coeffs[l*l+2*m]);
+        }
+    }
+    return p + d;
+}
+""" % {"name":name, "degree":self.degree, "n":n, "coeffs":coeffs, 
+       "n_norms":len(k), "norms":norms}
+
+calibration_models = {"gp":GPModel, "harmonic":HarmonicModel,
+                      "nystrom":lambda: GPModel(approximate="nystrom"),
+                      "rff":lambda: GPModel(approximate="rff")}
+
+def make_model(model):
+    """Return a calibration model, given either a model object or the 
+    name of one of calibration_models"""
+    if isinstance(model, str):
+        if model not in calibration_models:
+            raise CalibrationException("Unknown calibration model %s; must be one of %s" % 
+                                       (model, ", ".join(sorted(calibration_models))))
+        return calibration_models[model]()
+    return model
 
 def fix_angle(x):
     return np.arctan2(np.sin(x), np.cos(x))
 
 def augment_calibration(calibration):
-    xs, ys = calibration["tuio_x"], calibration["tuio_y"]
-    lonlat = np.array([sphere.tuio_to_polar(x,y) for x,y in zip(xs,ys)])    
+    xs, ys = calibration["tuio_x"].values, calibration["tuio_y"].values
+    lonlat = sphere.np_tuio_to_polar(xs, ys)
     calibration["touch_lon"],calibration["touch_lat"] = lonlat[:,0], lonlat[:,1]
 
     # fix angles
@@ -51,6 +398,13 @@ def latest_file(path, ext):
     newest = dated_files[0][1]
     return newest
 
+def get_calibrated_touches(tuio_x, tuio_y, gp):
+    """As get_calibrated_touch, for arrays of TUIO x and y coordinates. 
+    Returns an (N,2) array of lon, lat."""
+    lonlat = sphere.np_tuio_to_polar(tuio_x, tuio_y)
+    lonlat[:,0], lonlat[:,1] = gp_adjust_many(lonlat[:,0], lonlat[:,1], gp)
+    return lonlat
+
 def get_calibrated_touch(tuio_x, tuio_y, gp):
     """Returns the lon, lat co-ordinates (radians) of a touch point after applying calibration
     from the preset constants. Input is in tuio format (range [0,1] for x and y). 
@@ -61,19 +415,22 @@ def get_calibrated_touch(tuio_x, tuio_y, gp):
     lon,lat = gp_adjust(lon, lat, gp)
     return lon, lat
     
-def error_distribution(calibration, fn):
-    """Return the error distribution after applying fn"""
-    ds = []
-    for ix, row in calibration.iterrows():
-        lon, lat = row["target_lon"], row["target_lat"]
-        tlon, tlat = row["touch_lon"], row["touch_lat"]
-        
-        # compute offset from constant corrected
-        lonc, latc = fn(tlon, tlat)
-        d = sphere.spherical_distance((lon, lat), (lonc, latc))
-        ds.append(np.degrees(d))      
+def calibration_distances(calibration, lon="touch_lon", lat="touch_lat"):
+    """Return the distances between the targets and the given lon, lat columns
+    (by default, the uncorrected touches), as an array"""
+    # lon, lat pairs are passed in the order the original spherical_distance calls used,
+    # so results (and error statistics) are unchanged
+    return sphere.np_spherical_distance_latlon(calibration[["target_lon", "target_lat"]].values,
+                                               calibration[[lon, lat]].values)
 
-    return ds          
+def error_distribution(calibration, fn):
+    """Return the error distribution (in degrees) after applying fn, which 
+    takes arrays of lon, lat and returns corrected arrays of lon, lat"""
+    lonc, latc = fn(calibration["touch_lon"].values, calibration["touch_lat"].values)
+    # argument order as in calibration_distances
+    d = sphere.np_spherical_distance_latlon(calibration[["target_lon", "target_lat"]].values,
+                                            np.stack((lonc, latc), axis=1))
+    return np.degrees(d)
 
 def rms(x):
     return np.sqrt(np.mean(np.array(x)**2))
@@ -81,16 +438,116 @@ def rms(x):
 class CalibrationException(Exception):
     pass
 
-CALIBRATION_NOISE_LEVEL = 1e-2
+# bump when the cached state changes format
+CALIBRATION_CACHE_VERSION = 3
+
+class CalibrationCache(object):
+    """On-disk cache of trained calibrations, keyed by a hash of the 
+    calibration CSV contents and the training parameters. 
+
+    Each entry is a pickled dictionary of the Calibration's state. Editing 
+    the CSV or changing parameters changes the key, so stale entries are never 
+    used; older entries for the same CSV are removed when a new one is written."""
+    def __init__(self, path):
+        self.path = path
+
+    def key(self, csv_path, params):
+        """Return the cache key for the CSV file and the dictionary of parameters"""
+        h = hashlib.sha1()
+        h.update("%d\0" % CALIBRATION_CACHE_VERSION)
+        h.update(repr(sorted(params.items())))
+        with open(csv_path, "rb") as f:
+            h.update(f.read())
+        return h.hexdigest()
+
+    def _prefix(self, name):
+        return os.path.splitext(os.path.basename(name))[0]+"_"
+
+    def _fname(self, name, key):
+        return os.path.join(self.path, self._prefix(name)+key+".pkl")
+
+    def get(self, name, key):
+        """Return the cached state dictionary, or None"""
+        try:
+            with open(self._fname(name, key), "rb") as f:
+                return pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError, 
+                AttributeError, ImportError, ValueError):
+            return None
+
+    def put(self, name, key, state):
+        fname = self._fname(name, key)
+        try:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            # write then rename, so readers never see partial files
+            tmp_name = fname+".%d.tmp" % os.getpid()
+            with open(tmp_name, "wb") as f:
+                pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+            if os.path.exists(fname):
+                os.remove(fname)
+            os.rename(tmp_name, fname)
+            # remove stale entries for this calibration file
+            for old in os.listdir(self.path):
+                old = os.path.join(self.path, old)
+                if os.path.basename(old).startswith(self._prefix(name)) and old.endswith(".pkl") and old!=fname:
+                    os.remove(old)
+        except (IOError, OSError, pickle.PicklingError) as e:
+            print("Could not write calibration cache: %s" % e)
+
+calibration_cache = CalibrationCache(os.path.join("calibration", "cache"))
 
 class Calibration(object):
+    # the model functions (gp_adjust etc.) only use the predict() method
+    # so they work with any of the calibration models
     def get_calibrated_touch(self, x, y):
-        return get_calibrated_touch(x,y,self.gp)
+        if self.grid is None:
+            return get_calibrated_touch(x,y,self.model)
+        lon, lat = self.grid.lookup([x], [y])[0]
+        return lon, lat
 
     def adjust(self, lon, lat):
-        return gp_adjust(lon, lat, self.gp)
+        return gp_adjust(lon, lat, self.model)
+
+    def get_calibrated_touches(self, xs, ys):
+        """Calibrate arrays of TUIO co-ordinates; uses the correction grid, if there is one"""
+        if self.grid is None:
+            return get_calibrated_touches(xs, ys, self.model)
+        return self.grid.lookup(xs, ys)
+
+    def predict_cartesian(self, pts):
+        """Map (N,3) raw Cartesian touch points to corrected Cartesian points"""
+        return self.model.predict(pts)
+
+    def adjust_many(self, lon, lat):
+        """Adjust arrays of lon, lat in one pass; returns lon, lat arrays"""
+        return gp_adjust_many(lon, lat, self.model)
+
+    @property
+    def gp(self):
+        # the underlying GP, if the GP model is used
+        return getattr(self.model, "gp", None)
+
+    def model_tag(self):
+        """Short string identifying the model type and its parameters"""
+        h = hashlib.sha1(repr(sorted(self.model.params().items()))).hexdigest()
+        return "%s_%s" % (self.model.name, h[:8])
         
-    def __init__(self, calibration_name=None, exclude_distance=25):
+    # attributes saved in the calibration cache
+    cached_state = ["calibration", "model", "grid", "total_targets", "used_targets", 
+                    "unique", "reps", "min_latitude", "rms_error", "median_error"]
+
+    def __init__(self, calibration_name=None, exclude_distance=25, grid_resolution=256, grid_order=1, 
+                 cache=calibration_cache, model="gp"):
+        """
+        grid_resolution: size of the precomputed correction grid over TUIO space
+                         (None to always evaluate the model directly)
+        grid_order: 1 for bilinear, 3 for bicubic interpolation in the grid
+        cache: CalibrationCache storing trained calibrations, or None to always retrain
+        model: the correction model; either a name from calibration_models ("gp" or "harmonic")
+               or an unfitted model object, like HarmonicModel(degree=8)
+        """
+        self.model = make_model(model)
         if calibration_name is None:
             print "No calibration file specified."
             latest_csv = latest_file("calibration", ".csv")
@@ -100,6 +557,28 @@ class Calibration(object):
         print
 
         self.fname = calibration_name
+        
+        if cache is not None:
+            params = {"exclude_distance":exclude_distance, "model":self.model_tag(),
+                      "grid_resolution":grid_resolution, "grid_order":grid_order}
+            key = cache.key(os.path.join("calibration", calibration_name), params)
+            state = cache.get(calibration_name, key)
+            if state is not None:
+                self.__dict__.update(state)
+                print("Loaded cached calibration: %d of %d targets used" % (self.used_targets, self.total_targets))
+                print("RMS error: %.2f deg\nMedian error: %.2f deg" % (self.rms_error, self.median_error))
+                return
+            
+        # with a cache, the grid is stored in the cache entry, under the same key
+        self.train(exclude_distance, grid_resolution, grid_order, grid_file=cache is None)
+        if cache is not None:
+            cache.put(calibration_name, key, dict((k, getattr(self, k)) for k in self.cached_state))
+
+    def train(self, exclude_distance, grid_resolution, grid_order, grid_file=True):
+        """Read the calibration CSV, and fit the correction model and grid.
+        If grid_file is True, the grid is loaded from (or saved to) a file alongside the CSV;
+        otherwise it is always baked from the new fit."""
+        calibration_name = self.fname
         # read the calibration data
         calibration = pd.io.parsers.read_table(os.path.join("calibration", calibration_name), delimiter=",", skipinitialspace=True)
         augment_calibration(calibration)
@@ -107,8 +586,7 @@ class Calibration(object):
        
 
         # compute distances from estimated touches (w/o calibration) and target touches        
-        calibration["distance"] = [sphere.spherical_distance((r["target_lon"], r["target_lat"]),
-                                                        (r["touch_lon"], r["touch_lat"])) for ix, r in calibration.iterrows()]
+        calibration["distance"] = calibration_distances(calibration)
 
         
        
@@ -139,8 +617,8 @@ class Calibration(object):
 
         self.calibration = calibration
 
-        self.gp = train_gp(calibration, alpha=CALIBRATION_NOISE_LEVEL)       
-        error = error_distribution(calibration, lambda x,y:gp_adjust(x,y,self.gp))
+        self.model.fit(calibration)
+        error = error_distribution(calibration, self.adjust_many)
 
      
         self.rms_error = rms(error)
@@ -148,7 +626,177 @@ class Calibration(object):
         
         print("RMS error: %.2f deg\nMedian error: %.2f deg" % (self.rms_error, self.median_error))
 
+        self.grid = None
+        if grid_resolution is not None and grid_file:
+            self.grid = self.load_grid(grid_resolution, grid_order, exclude_distance)
+        elif grid_resolution is not None:
+            self.grid = self.bake_grid(grid_resolution, grid_order)
+
+    def bake_grid(self, resolution, order):
+        """Build the correction grid from the fitted model"""
+        grid = CorrectionGrid.from_model(self.predict_cartesian, resolution=resolution, order=order)
+        grid.measure_error(self.predict_cartesian)
+        print("Correction grid %dx%d: max deviation from model %.3f deg, mean %.4f deg" % 
+              (resolution, resolution, grid.max_error, grid.mean_error))
+        return grid
+
+    def load_grid(self, resolution, order, exclude_distance):
+        """Load the correction grid saved alongside the CSV, or bake and save 
+        a new one. The file name includes a hash of the CSV contents, exclude_distance
+        and the model parameters, so a grid is only reused for the same fit;
+        grids for other fits at this resolution and order are removed."""
+        csv_path = os.path.join("calibration", self.fname)
+        key = training_key(csv_path, exclude_distance, self.model_tag())
+        fname = os.path.join("calibration", grid_fname(self.fname, resolution, order, key))
+        if os.path.exists(fname):
+            grid = CorrectionGrid.load(fname)
+            print("Loaded correction grid %s" % fname)
+            if grid.max_error is not None:
+                print("Correction grid %dx%d: max deviation from model %.3f deg, mean %.4f deg" % 
+                      (resolution, resolution, grid.max_error, grid.mean_error))
+            return grid
+        grid = self.bake_grid(resolution, order)
+        try:
+            grid.save(fname)
+            stale = os.path.join("calibration", grid_fname(self.fname, resolution, order, "*"))
+            for old in glob.glob(stale):
+                if old!=fname:
+                    os.remove(old)
+        except (IOError, OSError) as e:
+            print("Could not save correction grid: %s" % e)
+        return grid
+
+class OnlineCalibration(object):
+    """Refines a trained Calibration from live (raw touch, target) pairs,
+    for example from interactions where the intended target is known.
+
+    The model weights are updated by recursive least squares: each pair is a 
+    rank-1 update of the normal equations, starting from those of the
+    offline calibration (scaled by prior_weight). Only the latest window
+    pairs are kept; older ones are removed by a rank-1 downdate.
+
+    Pairs are queued by add(), which never blocks. A worker thread applies
+    them, and every rebuild_every pairs it bakes a new model and correction 
+    grid and swaps them into the Calibration by attribute assignment, so 
+    readers always see a complete grid.
+
+    Needs a model with linear weights: "harmonic", "nystrom" or "rff"."""
+    def __init__(self, calibration, window=500, prior_weight=1.0, rebuild_every=20, max_queue=1000):
+        model = calibration.model
+        self.linear = model.gp if isinstance(model, GPModel) else model
+        if not hasattr(self.linear, "linear_system"):
+            raise CalibrationException("Online calibration needs a linear model (harmonic, nystrom or rff)")
+        self.calibration = calibration
+        self.window = window
+        self.rebuild_every = rebuild_every
+        touch, target = calibration_cartesian(calibration.calibration)
+        a, b = self.linear.linear_system(touch, target)
+        self.a, self.b = a*prior_weight, b*prior_weight
+        self.p = np.linalg.inv(self.a)
+        self.weights = np.array(self.linear.weights)
+        self.samples = collections.deque()
+        self.n_updates = 0
+        self.queue = Queue.Queue(max_queue)
+        self.dropped = 0
+        self.thread = None
+        self.running = False
+
+    def add(self, raw_x, raw_y, target_lon, target_lat):
+        """Queue a pair of raw TUIO touch and its true target lon, lat.
+        Pairs are dropped (and counted in self.dropped) if the queue is full."""
+        try:
+            self.queue.put_nowait((raw_x, raw_y, target_lon, target_lat))
+        except Queue.Full:
+            self.dropped += 1
+
+    def _rank_one(self, phi, r, sign):
+        # add (sign=1) or remove (sign=-1) one sample from the normal equations
+        # and update the inverse with the Sherman-Morrison formula
+        self.a += sign * np.outer(phi, phi)
+        self.b += sign * np.outer(phi, r)
+        p_phi = np.dot(self.p, phi)
+        self.p -= sign * np.outer(p_phi, p_phi) / (1 + sign*np.dot(phi, p_phi))
+
+    def update(self, raw_x, raw_y, target_lon, target_lat):
+        """Apply one pair immediately (called by the worker thread)"""
+        lon, lat = sphere.np_tuio_to_polar([raw_x], [raw_y])[0]
+        touch = np.array(sphere.spherical_to_cartesian((lon, lat)))
+        target = np.array(sphere.spherical_to_cartesian((target_lon, target_lat)))
+        phi = self.linear.features(touch[None,:])[0]
+        r = self.linear.residual(touch[None,:], target[None,:])[0]
+        if len(self.samples)>=self.window:
+            self._rank_one(*self.samples.popleft(), sign=-1)
+        self._rank_one(phi, r, sign=1)
+        self.samples.append((phi, r))
+        self.n_updates += 1
+        # recompute the inverse occasionally, so rounding errors do not accumulate
+        if self.n_updates % self.window == 0:
+            self.p = np.linalg.inv(self.a)
+        self.weights = np.dot(self.p, self.b)
+        if self.n_updates % self.rebuild_every == 0:
+            self.swap()
+
+    def swap(self):
+        """Bake the current weights into a new model (and grid) 
+        and swap them into the calibration"""
+        linear = copy.copy(self.linear)
+        linear.weights = self.weights.copy()
+        if isinstance(self.calibration.model, GPModel):
+            model = copy.copy(self.calibration.model)
+            model.gp = linear
+        else:
+            model = linear
+        grid = self.calibration.grid
+        if grid is not None:
+            grid = CorrectionGrid.from_model(model.predict, resolution=grid.resolution, order=grid.order)
+        # plain assignments; the OSC thread sees either the old or the new grid
+        self.calibration.model = model
+        self.calibration.grid = grid
+
+    def run(self):
+        while self.running:
+            try:
+                pair = self.queue.get(timeout=0.5)
+            except Queue.Empty:
+                continue
+            self.update(*pair)
+
+    def start(self):
+        """Start the worker thread"""
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+def compare_models(calibration_name=None, models=("gp", "harmonic"), n_timing=10000):
+    """Train each of the given models on the same calibration file, and
+    print the RMS and median error (degrees) and the prediction time per point"""
+    results = []
+    for model in models:
+        c = Calibration(calibration_name, grid_resolution=None, cache=None, model=model)
+        calibration_name = c.fname
+        pts = np.random.RandomState(0).normal(size=(n_timing, 3))
+        pts /= np.linalg.norm(pts, axis=1)[:,None]
+        start = timeit.default_timer()
+        c.predict_cartesian(pts)
+        t = (timeit.default_timer()-start) / n_timing
+        results.append((c.model_tag(), c.rms_error, c.median_error, t))
+    print
+    print("%-24s %10s %12s %16s" % ("Model", "RMSE", "Median", "Predict/point"))
+    for tag, rmse, median, t in results:
+        print("%-24s %8.3f deg %8.3f deg %13.2f us" % (tag, rmse, median, t*1e6))
+    return results
+
 if __name__=="__main__":
-    c = Calibration()
+    if len(sys.argv)>1 and sys.argv[1]=="compare":
+        compare_models(*sys.argv[2:3])
+    else:
+        c = Calibration()
 
         
\ No newline at end of file
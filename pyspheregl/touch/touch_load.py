@@ -0,0 +1,294 @@
+"""Generate synthetic multi-touch load as TUIO over OSC, for stress testing touch_zmq.
+
+A scenario is a JSON file:
+    {"rate": 500, "duration": 10, "jitter": 0.001, "drop": 0.01, "gap": 0.0, "seed": 0,
+     "gestures": [{"type": "fingers", "n": 10, "speed": 0.1},
+                  {"type": "swipe", "start": 1.0, "duration": 0.4, "from": [0.2, 0.5], "to": [0.6, 0.5], "n": 2},
+                  {"type": "palm", "start": 3.0, "duration": 1.0, "at": [0.5, 0.4], "n": 12},
+                  {"type": "taps", "rate": 4, "tap_time": 0.08}]}
+Positions are TUIO x, y (0-1). Gestures start at start (default 0) seconds and last
+for duration seconds (default: to the end). rate is frames per second; jitter is the
+standard deviation of the noise added to every position; drop is the probability
+that a frame is not sent at all, and gap the probability that fseq skips ahead.
+
+Usage:
+    python -m pyspheregl.touch.touch_load run [--scenario stress.json] [--fingers 10] [--rate 1000]
+                                              [--zmq_address tcp://localhost:4000]
+"""
+import json
+import time
+import timeit
+import numpy as np
+import OSC
+import zmq
+import fire
+
+from ..sim.products import get_product
+from ..touch.wire_format import JSON_TOPIC
+
+wall_clock = timeit.default_timer
+
+
+class Gesture(object):
+    """A gesture active from start for duration seconds. touches(t) returns
+    a dictionary mapping keys to TUIO x, y positions at time t; a key is
+    one touch for as long as it stays in the dictionary."""
+    def __init__(self, start=0.0, duration=None, seed=0):
+        self.start = start
+        self.duration = duration
+        self.rand = np.random.RandomState(seed)
+
+    def active(self, t):
+        return t>=self.start and (self.duration is None or t<self.start+self.duration)
+
+    def touches(self, t):
+        return {}
+
+def wrap(x, y):
+    # x wraps around the sphere, y is reflected at the ends
+    y = abs(y) % 2.0
+    return x % 1.0, 2.0-y if y>1 else y
+
+
+class Fingers(Gesture):
+    """n fingers moving in straight lines at speed TUIO units per second,
+    from random starting points with y in y_range"""
+    def __init__(self, n=5, speed=0.1, y_range=(0.05, 0.8), **kwargs):
+        Gesture.__init__(self, **kwargs)
+        self.origins = np.stack([self.rand.uniform(0, 1, n), self.rand.uniform(y_range[0], y_range[1], n)], axis=1)
+        angles = self.rand.uniform(0, 2*np.pi, n)
+        self.velocities = speed * np.stack([np.cos(angles), np.sin(angles)], axis=1)
+
+    def touches(self, t):
+        if not self.active(t):
+            return {}
+        pts = self.origins + self.velocities*(t-self.start)
+        return {i:wrap(x, y) for i, (x, y) in enumerate(pts.tolist())}
+
+
+class Swipe(Gesture):
+    """n fingers, spacing apart in y, moving from one point to another over the duration"""
+    def __init__(self, n=1, spacing=0.03, duration=0.5, **kwargs):
+        self.frm = np.array(kwargs.pop("from", (0.3, 0.5)), dtype=np.float64)
+        self.to = np.array(kwargs.pop("to", (0.7, 0.5)), dtype=np.float64)
+        Gesture.__init__(self, duration=duration, **kwargs)
+        self.offsets = np.arange(n)*spacing
+
+    def touches(self, t):
+        if not self.active(t):
+            return {}
+        x, y = self.frm + (self.to-self.frm)*(t-self.start)/self.duration
+        return {i:wrap(x, y+offset) for i, offset in enumerate(self.offsets)}
+
+
+class Palm(Gesture):
+    """n contacts scattered within radius of at, landing over the first land_time
+    seconds and wobbling slightly while the palm rests"""
+    def __init__(self, at=(0.5, 0.5), n=10, radius=0.03, land_time=0.03, wobble=0.002, **kwargs):
+        Gesture.__init__(self, **kwargs)
+        r = radius*np.sqrt(self.rand.uniform(0, 1, n))
+        angles = self.rand.uniform(0, 2*np.pi, n)
+        self.pts = np.array(at) + np.stack([r*np.cos(angles), r*np.sin(angles)], axis=1)
+        self.land = self.start + self.rand.uniform(0, land_time, n)
+        self.phases = self.rand.uniform(0, 2*np.pi, (n, 2))
+        self.wobble = wobble
+
+    def touches(self, t):
+        if not self.active(t):
+            return {}
+        pts = self.pts + self.wobble*np.sin(2*np.pi*t + self.phases)
+        return {i:wrap(x, y) for i, (x, y) in enumerate(pts.tolist()) if t>=self.land[i]}
+
+
+class Taps(Gesture):
+    """rate taps per second, each tap_time seconds long, at random positions with y in y_range"""
+    def __init__(self, rate=2.0, tap_time=0.08, y_range=(0.05, 0.8), **kwargs):
+        Gesture.__init__(self, **kwargs)
+        self.rate = rate
+        self.tap_time = tap_time
+        self.y_range = y_range
+        self.positions = {}
+
+    def position(self, tap):
+        # positions are drawn in tap order, so they don't depend on the frame rate
+        while len(self.positions)<=tap:
+            self.positions[len(self.positions)] = (self.rand.uniform(0, 1), self.rand.uniform(*self.y_range))
+        return self.positions[tap]
+
+    def touches(self, t):
+        if not self.active(t):
+            return {}
+        # taps overlap if tap_time > 1/rate
+        last = int(np.floor((t-self.start)*self.rate))
+        first = max(0, int(np.floor((t-self.start-self.tap_time)*self.rate)))
+        return {tap:self.position(tap) for tap in range(first, last+1) if t-self.start-tap/float(self.rate)<self.tap_time}
+
+
+gesture_types = {"fingers":Fingers, "swipe":Swipe, "palm":Palm, "taps":Taps}
+
+def make_gesture(spec, seed=0):
+    # construct a gesture from a scenario dictionary
+    spec = dict(spec)
+    kind = spec.pop("type")
+    if kind not in gesture_types:
+        raise ValueError("Unknown gesture type %s; expected one of %s" % (kind, ", ".join(sorted(gesture_types))))
+    spec.setdefault("seed", seed)
+    return gesture_types[kind](**spec)
+
+
+class Scenario(object):
+    """A set of gestures, sampled at rate frames per second for duration seconds.
+    frames() yields (fseq, t, touches), where touches maps TUIO session ids
+    to x, y positions; session ids are never reused."""
+    def __init__(self, gestures, rate=100.0, duration=10.0, jitter=0.0, drop=0.0, gap=0.0, seed=0):
+        self.gestures = gestures
+        self.rate = rate
+        self.duration = duration
+        self.jitter = jitter
+        self.drop = drop
+        self.gap = gap
+        self.rand = np.random.RandomState(seed)
+
+    @staticmethod
+    def load(path):
+        with open(path) as f:
+            spec = json.load(f)
+        seed = spec.get("seed", 0)
+        gestures = [make_gesture(g, seed+i) for i, g in enumerate(spec.pop("gestures", []))]
+        return Scenario(gestures, **spec)
+
+    def frames(self):
+        session_ids = {}
+        fseq = 0
+        for frame in range(int(self.duration*self.rate)):
+            t = frame/float(self.rate)
+            touches = {}
+            for g, gesture in enumerate(self.gestures):
+                for key, (x, y) in gesture.touches(t).items():
+                    if (g, key) not in session_ids:
+                        session_ids[g, key] = len(session_ids)
+                    touches[session_ids[g, key]] = x, y
+            if self.jitter>0 and len(touches)>0:
+                noise = self.rand.normal(0, self.jitter, (len(touches), 2))
+                touches = {id:wrap(x+dx, y+dy) for (id, (x, y)), (dx, dy) in zip(touches.items(), noise.tolist())}
+            if self.gap>0 and self.rand.uniform()<self.gap:
+                fseq += self.rand.randint(2, 10)
+            fseq += 1
+            if self.drop>0 and self.rand.uniform()<self.drop:
+                continue
+            yield fseq, t, touches
+
+
+class TUIOSender(object):
+    """Send TUIO 2Dcur frames over OSC: alive, set for each touch, then fseq.
+    If bundle is True, each frame is a single OSC bundle, as TUIO trackers send them;
+    otherwise each message is sent separately."""
+    def __init__(self, ip="127.0.0.1", port=3333, addr="/tuio/2Dcur", bundle=True):
+        self.client = OSC.OSCClient()
+        self.client.connect((ip, port))
+        self.addr = addr
+        self.bundle = bundle
+
+    def message(self, elements):
+        msg = OSC.OSCMessage()
+        msg.setAddress(self.addr)
+        for elt in elements:
+            msg.append(elt)
+        return msg
+
+    def send_frame(self, fseq, touches):
+        msgs = [self.message(["alive"]+list(touches.keys()))]
+        msgs.extend(self.message(["set", id, x, y, 0.0, 0.0, 0.0]) for id, (x, y) in touches.items())
+        msgs.append(self.message(["fseq", fseq]))
+        if self.bundle:
+            bundle = OSC.OSCBundle()
+            for msg in msgs:
+                bundle.append(msg)
+            self.client.send(bundle)
+        else:
+            for msg in msgs:
+                self.client.send(msg)
+
+    def close(self):
+        self.client.close()
+
+
+class TouchProbe(object):
+    """Subscribes to the ZMQ touch stream, matching received frames by fseq
+    to the times they were sent"""
+    def __init__(self, zmq_address):
+        context = zmq.Context()
+        self.socket = context.socket(zmq.SUB)
+        self.socket.setsockopt(zmq.SUBSCRIBE, JSON_TOPIC)
+        self.socket.connect(zmq_address)
+        self.sent = {}
+        self.delays = []
+
+    def poll(self):
+        while self.socket.poll(timeout=0)!=0:
+            parts = self.socket.recv_multipart(zmq.NOBLOCK)
+            if len(parts)==2:
+                sent = self.sent.pop(json.loads(parts[1])["fseq"], None)
+                if sent is not None:
+                    self.delays.append(wall_clock()-sent)
+
+    def report(self, n_sent):
+        delays = np.array(self.delays)*1000
+        print("Probe received %d of %d frames (%.1f%%)" % (len(delays), n_sent, 100.0*len(delays)/max(n_sent, 1)))
+        if len(delays)>0:
+            print("OSC send to ZMQ receive: median %.2fms, 99%% %.2fms, max %.2fms" %
+                  (np.median(delays), np.percentile(delays, 99), np.max(delays)))
+
+
+def run(scenario=None, product=None, fingers=5, rate=100.0, duration=10.0, jitter=0.0, drop=0.0, gap=0.0,
+        seed=0, bundle=True, zmq_address=None, wait=0.5):
+    """Send a scenario file (or, without one, fingers moving fingers) to the product's TUIO port.
+    rate, duration, jitter, drop and gap apply when there is no scenario file.
+    If zmq_address is given (e.g. tcp://localhost:4000), the frames touch_zmq publishes
+    are matched to those sent, to report the frames lost and the delay."""
+    product = get_product(product=product)
+    if scenario is not None:
+        scene = Scenario.load(scenario)
+    else:
+        scene = Scenario([Fingers(n=fingers, seed=seed)], rate=rate, duration=duration,
+                         jitter=jitter, drop=drop, gap=gap, seed=seed)
+    sender = TUIOSender(product["at_ip"], product["tuio_port"], product["tuio_addr"], bundle=bundle)
+    probe = None
+    if zmq_address is not None:
+        probe = TouchProbe(zmq_address)
+        time.sleep(wait) # let the subscription connect
+
+    # precompute the frames, so generating them doesn't limit the rate
+    frames = list(scene.frames())
+    n_sent, n_touches, late = 0, 0, 0.0
+    start = wall_clock()
+    try:
+        for fseq, t, touches in frames:
+            # sleep until close to the frame time, then spin
+            delay = start + t - wall_clock()
+            if delay>0.002:
+                time.sleep(delay-0.002)
+            while wall_clock()<start+t:
+                pass
+            late = max(late, wall_clock()-start-t)
+            if probe is not None:
+                probe.sent[fseq] = wall_clock()
+            sender.send_frame(fseq, touches)
+            n_sent += 1
+            n_touches += len(touches)
+            if probe is not None:
+                probe.poll()
+    except KeyboardInterrupt:
+        pass
+    elapsed = wall_clock()-start
+    print("Sent %d frames (%d touches) in %.2fs: %.1f frames/s, at most %.2fms late" %
+          (n_sent, n_touches, elapsed, n_sent/max(elapsed, 1e-9), late*1000))
+    if probe is not None:
+        time.sleep(wait)
+        probe.poll()
+        probe.report(n_sent)
+    sender.close()
+
+
+if __name__=="__main__":
+    fire.Fire({"run":run})
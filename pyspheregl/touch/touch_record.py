@@ -0,0 +1,217 @@
+"""Record the ZMQ touch stream to a log file, and replay it.
+
+The log is an append-only binary file: a header (LOG_HEADER: magic, version)
+followed by one record per message, each a fixed little-endian header
+    t (float64, time received), topic (uint8), length (uint32)
+followed by the message payload, exactly as it was published (JSON or packed
+binary, see wire_format.py). TouchLog memory-maps a log for reading; a record
+cut short by the recorder being killed is ignored.
+
+Usage:
+    python -m pyspheregl.touch.touch_record record touches.log [--zmq_address tcp://localhost:4000]
+    python -m pyspheregl.touch.touch_record replay touches.log [--speed 2.0] [--zmq_port 4000]
+    python -m pyspheregl.touch.touch_record benchmark touches.log
+"""
+import struct
+import mmap
+import os
+import time
+import timeit
+import zmq
+import numpy as np
+import fire
+
+from ..touch.wire_format import JSON_TOPIC, BINARY_TOPIC
+from ..sim.touch_manager import TouchManager, decode_frame
+
+wall_clock = timeit.default_timer
+
+LOG_HEADER = struct.Struct("<8sI")
+LOG_MAGIC = b"TOUCHLOG"
+LOG_VERSION = 1
+RECORD = struct.Struct("<dBI")
+TOPICS = [JSON_TOPIC, BINARY_TOPIC] # topic codes are indices into this
+
+class TouchLogException(Exception):
+    pass
+
+def subscribed_topics(topics):
+    # topics is "json", "binary" or "both"
+    if topics not in ("json", "binary", "both"):
+        raise ValueError("topics must be json, binary or both")
+    return {"json":[JSON_TOPIC], "binary":[BINARY_TOPIC], "both":TOPICS}[topics]
+
+
+class TouchLogWriter(object):
+    """Append records to a log file, creating it if needed"""
+    def __init__(self, path):
+        new = not os.path.exists(path) or os.path.getsize(path)==0
+        if not new:
+            check_header(path)
+        self.f = open(path, "ab")
+        if new:
+            self.f.write(LOG_HEADER.pack(LOG_MAGIC, LOG_VERSION))
+        self.n = 0
+
+    def write(self, t, topic, payload):
+        self.f.write(RECORD.pack(t, TOPICS.index(topic), len(payload)))
+        self.f.write(payload)
+        self.n += 1
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+def check_header(path):
+    with open(path, "rb") as f:
+        header = f.read(LOG_HEADER.size)
+    if len(header)<LOG_HEADER.size:
+        raise TouchLogException("%s is not a touch log" % path)
+    magic, version = LOG_HEADER.unpack(header)
+    if magic!=LOG_MAGIC:
+        raise TouchLogException("%s is not a touch log" % path)
+    if version!=LOG_VERSION:
+        raise TouchLogException("%s has unsupported version %d" % (path, version))
+
+
+class TouchLog(object):
+    """A memory-mapped touch log. ts, topics, offsets and lengths are arrays
+    with one entry per record; len(log) is the number of records, and log[i]
+    is the (t, topic, payload) of record i."""
+    def __init__(self, path):
+        check_header(path)
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.index()
+
+    def index(self):
+        # scan the record headers
+        ts, topics, offsets, lengths = [], [], [], []
+        pos, end = LOG_HEADER.size, len(self.mm)
+        while pos+RECORD.size<=end:
+            t, topic, length = RECORD.unpack_from(self.mm, pos)
+            if pos+RECORD.size+length>end:
+                break
+            ts.append(t)
+            topics.append(topic)
+            offsets.append(pos+RECORD.size)
+            lengths.append(length)
+            pos += RECORD.size+length
+        self.ts = np.array(ts, dtype=np.float64)
+        self.topics = np.array(topics, dtype=np.uint8)
+        self.offsets = np.array(offsets, dtype=np.int64)
+        self.lengths = np.array(lengths, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.ts)
+
+    def __getitem__(self, i):
+        offset = self.offsets[i]
+        return self.ts[i], TOPICS[self.topics[i]], self.mm[offset:offset+self.lengths[i]]
+
+    def frames(self, topics="both"):
+        """Iterate over the (t, topic, payload) of every record with one of the given topics"""
+        codes = [TOPICS.index(topic) for topic in subscribed_topics(topics)]
+        for i in np.nonzero(np.in1d(self.topics, codes))[0]:
+            yield self[i]
+
+    def close(self):
+        self.mm.close()
+
+
+def record(path, zmq_address="tcp://localhost:4000", topics="both", duration=None, flush_every=100):
+    """Append the touch frames published at zmq_address to the log at path,
+    until interrupted or for duration seconds. topics selects the frames
+    recorded: "json" (TOUCH), "binary" (BTOUCH) or "both"."""
+    context = zmq.Context()
+    socket = context.socket(zmq.SUB)
+    for topic in subscribed_topics(topics):
+        socket.setsockopt(zmq.SUBSCRIBE, topic)
+    socket.connect(zmq_address)
+    log = TouchLogWriter(path)
+    start = wall_clock()
+    try:
+        while duration is None or wall_clock()-start<duration:
+            if socket.poll(timeout=100)==0:
+                continue
+            parts = socket.recv_multipart()
+            if len(parts)==2 and parts[0] in TOPICS:
+                log.write(wall_clock(), parts[0], parts[1])
+                if log.n % flush_every==0:
+                    log.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        log.close()
+        socket.close()
+    print("Recorded %d frames to %s" % (log.n, path))
+
+
+def replay(path, zmq_port=4000, speed=1.0, topics="both", loop=False, wait=1.0):
+    """Publish the frames in the log at path on a ZMQ PUB socket on zmq_port,
+    keeping the recorded time between frames divided by speed (speed=0 sends
+    them as fast as possible). Waits wait seconds first, for subscribers to connect.
+    The frames are sent unchanged, so the timestamps inside them are the recorded ones."""
+    log = TouchLog(path)
+    context = zmq.Context()
+    socket = context.socket(zmq.PUB)
+    socket.bind("tcp://*:%s" % zmq_port)
+    time.sleep(wait)
+    sent, late = 0, 0.0
+    start = wall_clock()
+    try:
+        while True:
+            t0, pass_start = None, wall_clock()
+            for t, topic, payload in log.frames(topics):
+                if speed>0:
+                    if t0 is None:
+                        t0 = t
+                    delay = pass_start + (t-t0)/speed - wall_clock()
+                    if delay>0:
+                        time.sleep(delay)
+                    else:
+                        late = max(late, -delay)
+                socket.send_multipart([topic, payload])
+                sent += 1
+            if not loop:
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        elapsed = wall_clock()-start
+        socket.close()
+        log.close()
+    print("Sent %d frames in %.3fs (%.1f frames/s), at most %.2fms late" %
+          (sent, elapsed, sent/max(elapsed, 1e-9), late*1000))
+
+
+def benchmark(path, topic="json", cluster_size=0, repeat=1):
+    """Decode every frame with the given topic ("json" or "binary") in the log at path
+    and pass it to a TouchManager, without any sockets, reporting the time per frame.
+    cluster_size > 0 includes touch clustering, as in SphereViewer(cluster_size=...)."""
+    log = TouchLog(path)
+    frames = [payload for t, _, payload in log.frames(topic)]
+    log.close()
+    topic = subscribed_topics(topic)[0]
+    times, n_events = [], 0
+    for r in range(repeat):
+        manager = TouchManager(cluster_size=cluster_size)
+        for payload in frames:
+            start = wall_clock()
+            frame = decode_frame(topic, payload)
+            result = manager.touch_frame(frame["touches"], frame["raw"], fseq=frame["fseq"], t=frame["t"])
+            times.append(wall_clock()-start)
+            n_events += len(result["events"])
+    if len(times)==0:
+        print("No %s frames in %s" % (topic, path))
+        return
+    times = np.array(times)*1e6
+    print("%d frames, %d events: %.1f frames/s; per frame mean %.1fus, median %.1fus, 99%% %.1fus, max %.1fus" %
+          (len(times), n_events, len(times)/(np.sum(times)/1e6), np.mean(times), np.median(times),
+           np.percentile(times, 99), np.max(times)))
+
+
+if __name__=="__main__":
+    fire.Fire({"record":record, "replay":replay, "benchmark":benchmark})
@@ -8,7 +8,8 @@ from ..sphere import sphere as sphere
 import numpy as np
 wall_clock = timeit.default_timer
 
-from ..touch.touch_calibration import Calibration, CalibrationException
+from ..touch.touch_calibration import Calibration, CalibrationException, OnlineCalibration
+from ..touch.wire_format import encode_touch_frame, JSON_TOPIC, BINARY_TOPIC
 from  ..sim.products import get_product
 
 # logger for debug messages, when handling socket comms
@@ -158,15 +159,30 @@ class OSCMonitor:
 
         screen.refresh()
 
-    def convert_touch(self, x, y):
-        # convert the touch, using calibration is possible
+    def convert_touches(self, xs, ys):
+        # convert arrays of touches, using calibration if possible
+        # returns an (N,2) array of lon, lat
         if self.calibration is None:
             # no calibration, just use tuio_to_polar
-            return sphere.tuio_to_polar(x,y)
+            return sphere.np_tuio_to_polar(xs, ys)
         else:
-            # must convert calibrated touch to plain float tuple
-            lon, lat = self.calibration.get_calibrated_touch(x,y)
-            return (float(lon), float(lat))
+            return self.calibration.get_calibrated_touches(xs, ys)
+
+    def convert_frame(self):
+        # convert all the raw touches received this frame in one pass
+        # and store them in the touch list
+        ids = list(self.frame_raw.keys())
+        if len(ids)>0:
+            raw = np.array([self.frame_raw[touch_id] for touch_id in ids], dtype=np.float64)
+            lonlats = self.convert_touches(raw[:,0], raw[:,1])
+            for touch_id, (lon, lat) in zip(ids, lonlats):
+                # quick check solution strange inverted y hardware bug
+                # must convert calibrated touch to plain float tuple
+                if self.inverted_y:
+                    self.touch_list[touch_id] = float(lon), -float(lat)
+                else:
+                    self.touch_list[touch_id] = float(lon), float(lat)
+        self.frame_raw = {}
 
 
     def get_filtered_touches(self):                
@@ -176,6 +192,9 @@ class OSCMonitor:
     # reads OSC messages, broadcasts ZMQ back
     def handler(self, addr, tags, data, client_addr):
         self.last_packet = wall_clock()                
+        if self.frame_start is None:
+            # first packet of this frame, for latency measurement
+            self.frame_start = self.last_packet
         # store a trace of recent packets
         
         if len(self.packet_trace)>10:
@@ -187,32 +206,25 @@ class OSCMonitor:
             # decode the OSC packet
             if data[0]=='fseq':
                 # frame complete
+                self.convert_frame()
                 self.last_fseq = data[1]
                 # filter out too low touches
                 self.last_touch_list = self.get_filtered_touches()
                 self.all_touches = dict(self.touch_list)  
                 
                 # broadcast the raw touches themselves
-                self.zmq_socket.send_multipart(["TOUCH", json.dumps({"touches":self.last_touch_list, 
-                                                            "raw":self.raw_list,
-                                                            "fseq":self.last_fseq, 
-                                                            "stale":0,
-                                                            "t":self.last_packet})])
+                self.broadcast(self.last_touch_list, self.raw_list, self.last_fseq, 0, self.last_packet,
+                               osc_t=self.frame_start)
                 
                 self.touch_list = {}  
+                self.frame_start = None
                 
             
             # a single touch, accumulate into touch buffer
             if data[0]=='set':
                 touch_id, x, y = data[1:4]
-                lon, lat = self.convert_touch(x, y)
-
-                # quick check solution strange inverted y hardware bug
-                if self.inverted_y:
-                    self.touch_list[touch_id] = lon, -lat
-                else:
-                    self.touch_list[touch_id] = lon, lat
-                
+                # converted (and calibrated) in one batch when fseq arrives
+                self.frame_raw[touch_id] = x, y
                 self.raw_list[touch_id] = x, y
                 self.raws[touch_id] = x,y
              
@@ -232,6 +244,8 @@ class OSCMonitor:
         while True:
             # blocking wait, for up to timeout seconds
             self.osc_server.handle_request()
+            if self.online_calibration is not None:
+                self.receive_calibration()
             if screen:
                 self.update_display(screen)
         
@@ -242,10 +256,44 @@ class OSCMonitor:
                 
                 # broadcast a stale touch so subscribers know
                 # that touches aren't good any more
-                self.zmq_socket.send_multipart(["TOUCH", (json.dumps({"touches":{}, "raw":{}, "fseq":-2, "stale":1, "t":wall_clock()}))])
+                self.broadcast({}, {}, -2, 1, wall_clock())
 
                 
 
+    def broadcast(self, touches, raw, fseq, stale, t, osc_t=None):
+        # publish a frame of touches, in JSON and/or packed binary form
+        # stamped with the time the frame started arriving and the time it was published
+        stamps = {"osc":t if osc_t is None else osc_t, "publish":wall_clock()}
+        if self.wire_format in ("json", "both"):
+            self.zmq_socket.send_multipart([JSON_TOPIC, json.dumps({"touches":touches, 
+                                                                    "raw":raw,
+                                                                    "fseq":fseq, 
+                                                                    "stale":stale,
+                                                                    "t":t,
+                                                                    "stamps":stamps})])
+        if self.wire_format in ("binary", "both"):
+            self.zmq_socket.send_multipart([BINARY_TOPIC, encode_touch_frame(touches, raw, fseq, stale, t, stamps)])
+
+    def receive_calibration(self):
+        """Pass any pending calibration feedback messages to the online calibration.
+        Each message is JSON {"raw":[tuio_x, tuio_y], "target":[lon, lat]}, with the
+        target in the same co-ordinates as the touches that are broadcast."""
+        while True:
+            try:
+                msg = json.loads(self.calibration_socket.recv(zmq.NOBLOCK))
+            except zmq.Again:
+                return
+            except ValueError as e:
+                logger.exception(e)
+                continue
+            (x, y), (lon, lat) = msg["raw"], msg["target"]
+            # the calibration's output latitude is negated relative to its training
+            # targets (spherical_to_cartesian vs. cart_to_polar), and inverted_y 
+            # negates the broadcast latitude again (see convert_frame)
+            if not self.inverted_y:
+                lat = -lat
+            self.online_calibration.add(x, y, lon, lat)
+
     def _handler(self, *args, **kwargs):
         try:
             self.handler(*args, **kwargs)
@@ -256,9 +304,14 @@ class OSCMonitor:
 
     
     def monitor(self, product=None, zmq_port=4000, timeout=0.2, full_trace=False, console=True, 
-        no_calibration=False, calibration=None):
+        no_calibration=False, calibration=None, calibration_model="gp", online_calibration=False,
+        calibration_port=4001, wire_format="both"):
         """Listen to OSC messages on 3333. 
-        Broadcast on the ZMQ PUB stream on the given TCP port."""        
+        Broadcast on the ZMQ PUB stream on the given TCP port.
+        If online_calibration is set, (raw, target) pairs received on the 
+        ZMQ PULL socket calibration_port are used to refine the calibration.
+        wire_format selects the frames published: "json" (topic TOUCH), 
+        "binary" (topic BTOUCH, see wire_format.py) or "both"."""        
         
         # get the product to use, either from the command line
         # or from the environment variable, or use the default product
@@ -268,6 +321,9 @@ class OSCMonitor:
         self.osc_port = product["tuio_port"]
         self.osc_ip = product["at_ip"]
         self.zmq_port = zmq_port
+        if wire_format not in ("json", "binary", "both"):
+            raise ValueError("wire_format must be json, binary or both")
+        self.wire_format = wire_format
         self.timeout = timeout        
         self.full_trace = full_trace
         self.last_exception = ""
@@ -277,13 +333,21 @@ class OSCMonitor:
         self.min_latitude = -np.pi*0.45
         if not no_calibration:
             try:                
-                self.calibration = Calibration(calibration)
+                self.calibration = Calibration(calibration, model=calibration_model)
                 self.min_latitude = self.calibration.min_latitude
             except (CalibrationException, OSError) as e:
                 print(e)
                 self.calibration = None
         else:
             self.calibration = None
+
+        self.online_calibration = None
+        if online_calibration and self.calibration is not None:
+            try:
+                self.online_calibration = OnlineCalibration(self.calibration)
+                self.online_calibration.start()
+            except CalibrationException as e:
+                print(e)
         
         
         # reset the timeouts
@@ -296,6 +360,11 @@ class OSCMonitor:
         self.zmq_socket = context.socket(zmq.PUB)
         self.zmq_socket.bind("tcp://*:%s" % zmq_port)
 
+        # receive calibration feedback from clients
+        if self.online_calibration is not None:
+            self.calibration_socket = context.socket(zmq.PULL)
+            self.calibration_socket.bind("tcp://*:%s" % calibration_port)
+
         # listen for OSC events
         self.msg = product["tuio_addr"]
         self.osc_server = OSC.OSCServer((self.osc_ip, self.osc_port))  
@@ -304,7 +373,9 @@ class OSCMonitor:
 
         # clear the touch status
         self.last_fseq = -1
+        self.frame_start = None
         self.touch_list = {}
+        self.frame_raw = {} # raw touches waiting for the end of the frame
         self.last_touch_list = {}
         self.raw_list = {}
         self.all_touches = {}
@@ -0,0 +1,51 @@
+"""Packed binary format for touch frames sent over ZMQ.
+
+Frames are published on BINARY_TOPIC, alongside (or instead of) the JSON
+frames on JSON_TOPIC. The topic names do not share a prefix, so subscribers
+to one never receive the other.
+
+Each frame is a fixed little-endian header:
+    fseq (int32), t (float64), stale (int32), n (int32)
+followed by a struct-of-arrays:
+    ids (n x int32), lon, lat, raw_x, raw_y (each n x float32)
+and optionally a trailer of latency stamps:
+    osc (float64), publish (float64)
+"""
+import struct
+import numpy as np
+
+JSON_TOPIC = "TOUCH"
+BINARY_TOPIC = "BTOUCH"
+
+HEADER = struct.Struct("<idii")
+STAMPS = struct.Struct("<dd")
+
+def encode_touch_frame(touches, raw, fseq, stale, t, stamps=None):
+    """Pack a frame. touches maps touch ids to lon, lat; raw maps
+    touch ids to raw TUIO x, y (and must contain every id in touches).
+    stamps, if given, is a dictionary with the osc and publish times"""
+    ids = list(touches.keys())
+    n = len(ids)
+    soa = np.empty((4, n), dtype="<f4")
+    if n>0:
+        soa[0:2] = np.array([touches[id] for id in ids], dtype=np.float64).T
+        soa[2:4] = np.array([raw[id] for id in ids], dtype=np.float64).T
+    parts = [HEADER.pack(fseq, t, stale, n), np.array(ids, dtype="<i4").tobytes(), soa.tobytes()]
+    if stamps is not None:
+        parts.append(STAMPS.pack(stamps["osc"], stamps["publish"]))
+    return b"".join(parts)
+
+def decode_touch_frame(data):
+    """Unpack a frame, without copying the arrays. Returns a dictionary with
+    fseq, t, stale, ids (n,), lonlat (n,2) and raw (n,2). The arrays are
+    read-only views of data. If the frame has latency stamps, they are 
+    returned as a dictionary in stamps."""
+    fseq, t, stale, n = HEADER.unpack_from(data)
+    ids = np.frombuffer(data, dtype="<i4", count=n, offset=HEADER.size)
+    soa = np.frombuffer(data, dtype="<f4", count=4*n, offset=HEADER.size+4*n).reshape(4, n)
+    frame = {"fseq":fseq, "t":t, "stale":stale, "ids":ids,
+             "lonlat":soa[0:2].T, "raw":soa[2:4].T}
+    end = HEADER.size+20*n
+    if len(data)>=end+STAMPS.size:
+        frame["stamps"] = dict(zip(["osc", "publish"], STAMPS.unpack_from(data, end)))
+    return frame
@@ -3,6 +3,7 @@ import traceback
 from ctypes import *
 import thread
 from pyglet.gl import *
+import numpy as np
 
 from . import np_vbo, shader
 class Texture:
@@ -68,6 +69,22 @@ class FBOContext:
         
     
 
+    def read_touch_ids(self, xs, ys, out=None):
+        """Read the touch buffer (COLOR_ATTACHMENT1) at the given pixel
+        positions only, instead of copying back the whole texture.
+        Returns an array of uint32 object ids, one per position."""
+        n = len(xs)
+        if out is None:
+            out = np.zeros(n, dtype=np.uint32)
+        glBindFramebuffer(GL_READ_FRAMEBUFFER, self.fbo_buffer)
+        glReadBuffer(GL_COLOR_ATTACHMENT1)
+        for i in range(n):
+            glReadPixels(int(xs[i]), int(ys[i]), 1, 1, GL_RED_INTEGER, GL_UNSIGNED_INT, 
+                         out.ctypes.data + i*out.itemsize)
+        glReadBuffer(GL_COLOR_ATTACHMENT0)
+        glBindFramebuffer(GL_READ_FRAMEBUFFER, 0)
+        return out
+
     def __enter__(self):        
         #enable render buffer
         glBindFramebuffer(GL_FRAMEBUFFER, self.fbo_buffer)        
@@ -81,4 +98,72 @@ class FBOContext:
         glBindFramebuffer(GL_FRAMEBUFFER, 0)
         glViewport(*self.real_viewport)
         
-      
\ No newline at end of file
+      
+
+class PBOReadback:
+    """Asynchronous readback of a texture into a numpy array, using a ring
+    of pixel buffer objects. Each call to read() queues a copy of the texture
+    into the next PBO and copies any reads that have already completed into
+    `out`, so the array always holds the most recently completed frame.
+
+    n_buffers sets the latency/throughput trade-off: with n buffers, the
+    results in `out` are up to n-1 frames old, and read() only ever blocks
+    if all n reads are still in flight."""
+    def __init__(self, texture, out, n_buffers=2, format=GL_RED_INTEGER, type=GL_UNSIGNED_INT):
+        self.texture = texture
+        self.out = out
+        self.format = format
+        self.type = type
+        self.n_buffers = n_buffers
+        self.nbytes = out.nbytes
+        self.pbos = (GLuint * n_buffers)()
+        glGenBuffers(n_buffers, self.pbos)
+        for pbo in self.pbos:
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
+            glBufferData(GL_PIXEL_PACK_BUFFER, self.nbytes, None, GL_STREAM_READ)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        self.pending = [] # (pbo index, fence) pairs, oldest first
+        self.issued = 0
+
+    def _copy(self, ix, fence, wait):
+        # copy a completed read into the output array
+        # returns False if the read is not ready yet and wait is False
+        timeout = GL_TIMEOUT_IGNORED if wait else 0
+        status = glClientWaitSync(fence, GL_SYNC_FLUSH_COMMANDS_BIT, timeout)
+        if status not in (GL_ALREADY_SIGNALED, GL_CONDITION_SATISFIED):
+            return False
+        glDeleteSync(fence)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, self.pbos[ix])
+        ptr = glMapBufferRange(GL_PIXEL_PACK_BUFFER, 0, self.nbytes, GL_MAP_READ_BIT)
+        if ptr:
+            memmove(self.out.ctypes.data, ptr, self.nbytes)
+        glUnmapBuffer(GL_PIXEL_PACK_BUFFER)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        return True
+
+    def collect(self):
+        """Copy all completed reads into the output array, without blocking
+        unless every buffer in the ring is still waiting."""
+        while len(self.pending)>0:
+            ix, fence = self.pending[0]
+            if not self._copy(ix, fence, wait=len(self.pending)>=self.n_buffers):
+                break
+            self.pending.pop(0)
+
+    def read(self):
+        """Queue a read of the texture, and collect any finished reads."""
+        self.collect()
+        ix = self.issued % self.n_buffers
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, self.pbos[ix])
+        glBindTexture(self.texture.target, self.texture.id)
+        # with a pack buffer bound, the pointer is an offset into the PBO
+        glGetTexImage(self.texture.target, 0, self.format, self.type, 0)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        self.pending.append((ix, glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)))
+        self.issued += 1
+
+    def delete(self):
+        for ix, fence in self.pending:
+            glDeleteSync(fence)
+        self.pending = []
+        glDeleteBuffers(self.n_buffers, self.pbos)
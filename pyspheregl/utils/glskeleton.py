@@ -83,7 +83,7 @@ class GLSkeleton:
     
         
     # init routine, sets up the engine, then enters the main loop
-    def __init__(self, draw_fn = None, tick_fn = None, event_fn = None, key_fn=None, resize_fn = None, mouse_fn = None, exit_fn=None, window_size=(800,600), debug=True, fullscreen=False):    
+    def __init__(self, draw_fn = None, tick_fn = None, event_fn = None, key_fn=None, resize_fn = None, mouse_fn = None, exit_fn=None, window_size=(800,600), debug=True, fullscreen=False, flip_fn=None):    
         #self.init_pygame(window_size[0], window_size[1], fullscreen)
         if not debug:
             # faster, but unsafe operation
@@ -97,6 +97,7 @@ class GLSkeleton:
         self.key_fn = key_fn
         self.exit_fn = exit_fn
         self.mouse_fn = mouse_fn        
+        self.flip_fn = flip_fn # called after each buffer flip
         self.running = True
         self.actual_fps = self.fps # until we update when running
         
@@ -125,6 +126,8 @@ class GLSkeleton:
             self.tick(1/self.fps)
             self.on_draw()
             self.window.flip()
+            if self.flip_fn:
+                self.flip_fn()
             self.actual_fps = pyglet.clock.get_fps()
             
 
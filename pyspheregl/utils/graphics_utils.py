@@ -113,37 +113,52 @@ def make_circle_fan(n_divs, radius=1.0):
     return np.array(indices, dtype=np.uint32), np.array(vertices, dtype=np.float32)
 
     
-def make_unit_quad_tile(n_divs, x1=0.0, x2=1.0, y1=0.0, y2=1.0, tx1=0.0, tx2=1.0, ty1=0.0, ty2=1.0, n_quads=1):
+_quad_tile_cache = {}
+
+def make_unit_quad_tile(n_divs, x1=0.0, x2=1.0, y1=0.0, y2=1.0, tx1=0.0, tx2=1.0, ty1=0.0, ty2=1.0, n_quads=1, 
+                        shared=False, triangles=False):
     # subdivide a rectangle into n_divs x n_divs smaller sub-rectangles, with corresponding texture coordinates
-    vertices = []
-    indices = []
-    texs = []
-    ix = 0
-    for k in range(n_quads):
-        x, y = x1, y1 
-        xdiv = (x2-x1)/n_divs
-        ydiv = (y2-y1)/n_divs
-        
-        txdiv = (tx2-tx1)/n_divs
-        tydiv = (ty2-ty1)/n_divs
-        tx, ty = tx1, ty1
-        
-       
-        
-        for i in range(n_divs):
-            x = x1
-            tx = tx1
-            for j in range(n_divs):
-                vertices += [[x,y], [x+xdiv, y], [x+xdiv, y+ydiv], [x, y+ydiv]]
-                texs +=     [[tx,ty], [tx+txdiv, ty], [tx+txdiv, ty+tydiv], [tx, ty+tydiv]]
-                indices +=  [ix, ix+1, ix+2, ix+3]
-                ix += 4
-                x += xdiv
-                tx += txdiv
-            y += ydiv
-            ty += tydiv
-       
-    return np.array(indices, dtype=np.uint32), np.array(vertices, dtype=np.float32)*2-1, np.array(texs, dtype=np.float32)
+    # returns indices, vertices (scaled to [-1,1]) and texture coordinates
+    # if shared is True, neighbouring quads share vertices ((n_divs+1)**2 vertices instead of 4*n_divs**2)
+    # if triangles is True, indices are for GL_TRIANGLES (two per quad) instead of GL_QUADS
+    # results are cached, and are read-only
+    key = (n_divs, x1, x2, y1, y2, tx1, tx2, ty1, ty2, n_quads, shared, triangles)
+    if key not in _quad_tile_cache:
+        tile = _make_unit_quad_tile(*key)
+        for arr in tile:
+            arr.flags.writeable = False
+        _quad_tile_cache[key] = tile
+    return _quad_tile_cache[key]
+
+def _make_unit_quad_tile(n_divs, x1, x2, y1, y2, tx1, tx2, ty1, ty2, n_quads, shared, triangles):
+    f = np.arange(n_divs+1) / float(n_divs)
+    # grid coordinates, as [row (y), column (x)]
+    xs, ys = np.meshgrid(x1 + (x2-x1)*f, y1 + (y2-y1)*f)
+    txs, tys = np.meshgrid(tx1 + (tx2-tx1)*f, ty1 + (ty2-ty1)*f)
+    vertices = np.stack((xs, ys), axis=-1)
+    texs = np.stack((txs, tys), axis=-1)
+
+    # corners of each quad, in the order (x,y), (x+1,y), (x+1,y+1), (x,y+1)
+    grid = np.arange((n_divs+1)**2).reshape(n_divs+1, n_divs+1)
+    corners = np.stack((grid[:-1,:-1], grid[:-1,1:], grid[1:,1:], grid[1:,:-1]), axis=-1).reshape(-1, 4)
+
+    if shared:
+        vertices, texs = vertices.reshape(-1, 2), texs.reshape(-1, 2)
+        quads = corners        
+    else:
+        # every quad gets its own four vertices
+        vertices, texs = vertices.reshape(-1, 2)[corners].reshape(-1, 2), texs.reshape(-1, 2)[corners].reshape(-1, 2)
+        quads = np.arange(len(vertices)).reshape(-1, 4)
+
+    if triangles:
+        quads = quads[:,[0,1,2,0,2,3]]
+
+    # repeat for each of the n_quads copies
+    n_vtxs = len(vertices)
+    indices = (quads.reshape(1, -1) + n_vtxs * np.arange(n_quads).reshape(-1, 1)).ravel()
+    vertices = np.tile(vertices, (n_quads, 1))
+    texs = np.tile(texs, (n_quads, 1))
+    return indices.astype(np.uint32), vertices.astype(np.float32)*2-1, texs.astype(np.float32)
  
  
 
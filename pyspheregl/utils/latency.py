@@ -0,0 +1,176 @@
+"""Touch latency measurement.
+
+Touch frames carry a dictionary of time stamps (from wall_clock) as they pass
+through the pipeline, one for each of STAGES:
+    osc       first OSC packet of the frame received by touch_zmq
+    publish   frame published over ZMQ
+    receive   frame received by ZMQTouchHandler
+    dispatch  events passed to touch_fn
+    submit    drawing for the next frame submitted
+    flip      buffers flipped, so the frame is on its way to the display
+LatencyTracer collects the stamps of each frame that produced events and keeps a
+LatencyHistogram of the time from osc to each stage, and of each stage from the one before.
+Stamps from different processes are only comparable on the same machine.
+"""
+import sys
+import timeit
+import numpy as np
+
+wall_clock = timeit.default_timer
+
+STAGES = ["osc", "publish", "receive", "dispatch", "submit", "flip"]
+
+
+class LatencyHistogram(object):
+    """HDR-style histogram of durations in seconds, from lowest to highest,
+    with a fixed relative precision of significant_figures. Buckets are linear
+    up to 2*10**significant_figures units of lowest and then logarithmic, so the
+    size is fixed and recording is constant time. Values outside the range are clamped."""
+    def __init__(self, lowest=1e-6, highest=10.0, significant_figures=2):
+        self.unit = lowest
+        self.sub_bits = int(np.ceil(np.log2(2*10**significant_figures)))
+        self.sub_count = 1<<self.sub_bits
+        self.half = self.sub_count>>1
+        self.max_units = int(np.ceil(highest/lowest))
+        self.counts = np.zeros(int(self.index(self.max_units))+1, dtype=np.int64)
+        self.reset()
+
+    def reset(self):
+        self.counts[:] = 0
+        self.total = 0
+        self.sum = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def index(self, units):
+        # bucket index of integer values, in units of lowest
+        units = np.asarray(units, dtype=np.int64)
+        _, bits = np.frexp(units) # bits is the bit length, for integers
+        shift = np.maximum(bits-self.sub_bits, 0)
+        return np.where(shift==0, units, self.sub_count + (shift-1)*self.half + (units>>shift) - self.half)
+
+    def value(self, index):
+        # the middle of the range of values in the given bucket, in seconds
+        index = np.asarray(index, dtype=np.int64)
+        linear = index<self.sub_count
+        shift = np.where(linear, 0, (index-self.sub_count)//self.half + 1)
+        sub = np.where(linear, index, (index-self.sub_count)%self.half + self.half)
+        return ((sub<<shift) + ((1<<shift)-1)/2.0) * self.unit
+
+    def record(self, value):
+        self.record_many([value])
+
+    def record_many(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if len(values)==0:
+            return
+        units = np.clip(np.floor(values/self.unit), 0, self.max_units)
+        self.counts += np.bincount(self.index(units), minlength=len(self.counts))
+        self.total += len(values)
+        self.sum += float(np.sum(values))
+        self.min = min(self.min, float(np.min(values)))
+        self.max = max(self.max, float(np.max(values)))
+
+    def merge(self, other):
+        """Add the counts from another histogram with the same range and precision"""
+        if len(other.counts)!=len(self.counts) or other.unit!=self.unit:
+            raise ValueError("Histograms have different ranges or precision")
+        self.counts += other.counts
+        self.total += other.total
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def count(self):
+        return self.total
+
+    @property
+    def mean(self):
+        return self.sum/self.total if self.total>0 else np.nan
+
+    def percentile(self, p):
+        """Value (in seconds) below which p percent of the recorded values fall"""
+        if self.total==0:
+            return np.nan
+        rank = max(1, int(np.ceil(p/100.0*self.total)))
+        index = np.searchsorted(np.cumsum(self.counts), rank)
+        return float(np.clip(self.value(index), self.min, self.max))
+
+    def summary(self):
+        """Dictionary of count, min, mean, p50, p90, p99, p99.9 and max (in seconds)"""
+        summary = {"count":self.total, "min":self.min if self.total>0 else np.nan,
+                   "mean":self.mean, "max":self.max if self.total>0 else np.nan}
+        for p in [50, 90, 99, 99.9]:
+            summary["p%g" % p] = self.percentile(p)
+        return summary
+
+
+def _print(text):
+    sys.stdout.write(text+"\n")
+
+class LatencyTracer(object):
+    """Collects the stamps of touch frames, as described above. Frames are added
+    with add() when their events are dispatched, stamped with stamp() at later stages,
+    and recorded by complete(). totals[stage] is the histogram of the time from
+    osc to stage; steps[stage] of the time from the previous stage that was stamped.
+
+    Every log_every seconds, report() is passed to log_fn (by default, printed);
+    if reset_on_log is True, the histograms are then cleared, so each report covers
+    one interval. log_every=None disables logging."""
+    def __init__(self, log_every=10.0, log_fn=None, reset_on_log=True, **histogram_args):
+        self.totals = {stage:LatencyHistogram(**histogram_args) for stage in STAGES[1:]}
+        self.steps = {stage:LatencyHistogram(**histogram_args) for stage in STAGES[1:]}
+        self.pending = []
+        self.log_every = log_every
+        self.log_fn = log_fn or _print
+        self.reset_on_log = reset_on_log
+        self.last_log = wall_clock()
+
+    def add(self, stamps):
+        self.pending.append(stamps)
+
+    def stamp(self, stage, t=None):
+        # stamp all the pending frames that haven't reached this stage
+        t = wall_clock() if t is None else t
+        for stamps in self.pending:
+            stamps.setdefault(stage, t)
+
+    def complete(self):
+        # record all the pending frames
+        for stamps in self.pending:
+            self.record(stamps)
+        self.pending = []
+        if self.log_every is not None and wall_clock()-self.last_log>=self.log_every:
+            self.log()
+
+    def record(self, stamps):
+        if "osc" not in stamps:
+            return
+        last = stamps["osc"]
+        for stage in STAGES[1:]:
+            if stage in stamps:
+                self.totals[stage].record(stamps[stage]-stamps["osc"])
+                self.steps[stage].record(stamps[stage]-last)
+                last = stamps[stage]
+
+    def reset(self):
+        for hist in list(self.totals.values())+list(self.steps.values()):
+            hist.reset()
+
+    def report(self):
+        """Table of latency percentiles (in ms) for each stage"""
+        lines = ["%-10s %7s %9s %9s %9s %9s   %9s %9s" % ("touch", "frames", "p50", "p90", "p99", "max",
+                                                           "step p50", "step p99")]
+        for stage in STAGES[1:]:
+            total, step = self.totals[stage].summary(), self.steps[stage].summary()
+            lines.append("%-10s %7d %7.2fms %7.2fms %7.2fms %7.2fms   %7.2fms %7.2fms" %
+                         (stage, total["count"], total["p50"]*1e3, total["p90"]*1e3, total["p99"]*1e3,
+                          total["max"]*1e3, step["p50"]*1e3, step["p99"]*1e3))
+        return "\n".join(lines)
+
+    def log(self):
+        self.log_fn(self.report())
+        self.last_log = wall_clock()
+        if self.reset_on_log:
+            self.reset()
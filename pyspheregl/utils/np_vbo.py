@@ -2,14 +2,22 @@ import pyglet
 from pyglet.gl import *
 import numpy as np
 
+# buffers with a structured dtype are interleaved: one VBO, with each 
+# field attached to the vertex attribute of the same name.
+# float fields are read as floats; integer fields are read as ints 
+# (glVertexAttribIPointer), unless named in normalized, in which case 
+# they are read as floats scaled to [0,1] or [-1,1]
 class VBuf:
-    def __init__(self,  buffer, name="", id=-1, divisor=-1, mode=GL_STATIC_DRAW):
+    def __init__(self,  buffer, name="", id=-1, divisor=-1, mode=GL_STATIC_DRAW, normalized=None):
         self.buffer = create_vbo(buffer, mode=mode)
         self.name = name
         self.id = id
         self.shape = buffer.shape
         self.divisor = divisor
         self.mode = mode
+        self.fields = buffer.dtype.names
+        self.field_ids = {} # attribute location of each field
+        self.normalized = set(normalized or [])
 
     def set(self, array):
         assert(self.shape==array.shape)
@@ -17,6 +25,28 @@ class VBuf:
         #self.buffer.set_data(array.astype(np.float32).ctypes.data)
 
 
+class StreamVBuf(VBuf):
+    """A VBuf for data which is rewritten every frame (e.g. touch points
+    or animated instance positions). See StreamVBO."""
+    def __init__(self, buffer, name="", id=-1, divisor=-1, normalized=None):
+        self.buffer = StreamVBO(buffer)
+        self.name = name
+        self.id = id
+        self.shape = buffer.shape
+        self.divisor = divisor
+        self.mode = GL_STREAM_DRAW
+        self.fields = buffer.dtype.names
+        self.field_ids = {}
+        self.normalized = set(normalized or [])
+
+    def set(self, array, start=0, end=None):
+        """Upload array; if start, end are given only rows [start:end] 
+        have changed, and only those are uploaded. If start is 0, rows
+        after end are undefined until they are uploaded again."""
+        assert(self.shape==array.shape)
+        self.buffer.set_data(array, start, end)
+
+
 
 
 def create_vao(vbufs, ibo):
@@ -31,10 +61,17 @@ def create_vao(vbufs, ibo):
  
     # attach vbos
     for vbuf in vbufs:
-        glEnableVertexAttribArray(vbuf.id)
-        attach_vbo(vbuf.buffer, vbuf.id)        
-        if vbuf.divisor!=-1:
-            glVertexAttribDivisor(vbuf.id, vbuf.divisor)
+        if vbuf.fields is None:
+            glEnableVertexAttribArray(vbuf.id)
+            attach_vbo(vbuf.buffer, vbuf.id)        
+            if vbuf.divisor!=-1:
+                glVertexAttribDivisor(vbuf.id, vbuf.divisor)
+        else:
+            # interleaved; attach each field separately
+            for field, id in vbuf.field_ids.items():
+                attach_vbo(vbuf.buffer, id, field=field, normalized=field in vbuf.normalized)
+                if vbuf.divisor!=-1:
+                    glVertexAttribDivisor(id, vbuf.divisor)
 
     if ibo!=None:
         glBindBuffer(ibo.target, ibo.id)
@@ -70,7 +107,8 @@ class VBO:
         # upload the placeholder data
         # must be the same shape on subsequent updates!
         
-        data = data.astype(np.float32)
+        self.dtype = data.dtype if data.dtype.names else np.dtype(np.float32)
+        data = self.as_buffer_type(data)
         glBufferData(self.target, data.nbytes, data.ctypes.data, self.mode)        
         
         self.nbytes = data.nbytes                
@@ -84,12 +122,44 @@ class VBO:
     def unbind(self):
         glBindBuffer(self.target, 0)
 
+    def as_buffer_type(self, data):
+        # structured buffers keep their own dtype, everything else is float32
+        if self.dtype.names:
+            return np.ascontiguousarray(data, dtype=self.dtype)
+        return as_float32(data)
+
     def set_data(self, data):
-        data = data.astype(np.float32)
+        data = self.as_buffer_type(data)
         assert(data.nbytes == self.nbytes and data.shape==self.shape)
         self.bind()
         glBufferSubData(self.target, 0, data.nbytes, data.ctypes.data)
         
+class StreamVBO(VBO):
+    """VBO for per-frame data. Updates starting at row 0 orphan the old 
+    storage first, so the upload never waits for draws still reading the
+    previous contents; only rows [0:end] are then defined, so only those
+    should be drawn. Updates starting later upload only the given rows
+    into the existing storage."""
+    def __init__(self, data, mode=GL_STREAM_DRAW):
+        VBO.__init__(self, data, mode)
+        self.row_bytes = self.nbytes // max(1, self.shape[0])
+
+    def set_data(self, data, start=0, end=None):
+        data = self.as_buffer_type(data)
+        assert(data.nbytes == self.nbytes and data.shape==self.shape)
+        if end is None:
+            end = self.shape[0]
+        self.bind()
+        if start==0:
+            # orphan the buffer; the driver allocates fresh storage
+            glBufferData(self.target, self.nbytes, None, self.mode)
+        if end>start:
+            offset = start * self.row_bytes
+            glBufferSubData(self.target, offset, (end-start) * self.row_bytes, data.ctypes.data + offset)
+
+def as_float32(data):
+    """Return data as a contiguous float32 array, without copying if it already is one"""
+    return np.ascontiguousarray(data, dtype=np.float32)
         
 
 
@@ -115,12 +185,40 @@ def create_elt_buffer(arr, mode=GL_STATIC_DRAW):
 def IBuf(arr):
     return create_elt_buffer(arr)
 
-def attach_vbo(bo, n):
-    """Attach a vertex buffer object to attribute pointer n"""
+# GL types for each numpy type that can be used in a vertex buffer
+gl_types = {
+    np.dtype(np.float16):GL_HALF_FLOAT,
+    np.dtype(np.float32):GL_FLOAT,
+    np.dtype(np.float64):GL_DOUBLE,
+    np.dtype(np.int8):GL_BYTE,
+    np.dtype(np.uint8):GL_UNSIGNED_BYTE,
+    np.dtype(np.int16):GL_SHORT,
+    np.dtype(np.uint16):GL_UNSIGNED_SHORT,
+    np.dtype(np.int32):GL_INT,
+    np.dtype(np.uint32):GL_UNSIGNED_INT,
+}
+
+def attach_vbo(bo, n, field=None, normalized=False):
+    """Attach a vertex buffer object to attribute pointer n. 
+    If field is given, attach that field of an interleaved (structured) buffer"""
     glEnableVertexAttribArray(n)
     glBindBuffer(bo.target, bo.id)        
-    # use number of elements in last element of the buffer object
-    glVertexAttribPointer(n, bo.shape[-1], GL_FLOAT, False, 0, 0)
+    if field is None:
+        # use number of elements in last element of the buffer object
+        glVertexAttribPointer(n, bo.shape[-1], GL_FLOAT, False, 0, 0)
+        return
+
+    dtype, offset = bo.dtype.fields[field][:2]
+    # fields like ("position", np.float32, 2) have a subarray shape
+    base, shape = dtype.subdtype or (dtype, ())
+    size = int(np.prod(shape))
+    if base not in gl_types or size<1 or size>4:
+        raise ValueError("Can't use field %s with type %s as a vertex attribute" % (field, dtype))
+    stride = bo.dtype.itemsize
+    if base.kind in "iu" and not normalized:
+        glVertexAttribIPointer(n, size, gl_types[base], stride, offset)
+    else:
+        glVertexAttribPointer(n, size, gl_types[base], normalized, stride, offset)
 
 
 def draw_elt_buffer(elt_bo, primitives=GL_QUADS):
@@ -37,6 +37,7 @@ DEALINGS IN THE SOFTWARE.
   
 """
 
+import pyglet
 from pyglet.gl import *
 from ctypes import *
 import contextlib
@@ -63,14 +64,103 @@ def if_in_use(f):
     return execute_if_in_use
   
 import os
+import hashlib
+import struct
+
+
+class ProgramCache(object):
+    """Cache of linked program binaries (from glGetProgramBinary), keyed by 
+    a hash of the shader sources and the GL driver. 
+
+    Binaries are kept in memory, so identical source sets are only compiled 
+    once per process, and (if path is not None) written to path, so 
+    they survive restarts. Binaries the driver rejects are discarded and
+    the program is recompiled from source."""
+    def __init__(self, path=None):
+        self.path = path
+        self.binaries = {}
+        self.hits = 0
+        self.misses = 0
+        self._supported = None
+
+    def supported(self):
+        # drivers may support no binary formats at all
+        if self._supported is None:
+            n_formats = GLint(0)
+            glGetIntegerv(GL_NUM_PROGRAM_BINARY_FORMATS, byref(n_formats))
+            self._supported = n_formats.value>0
+        return self._supported
+
+    def key(self, vert, frag, geom):
+        """Return the cache key for the given lists of source strings"""
+        info = pyglet.gl.gl_info
+        h = hashlib.sha1()
+        h.update("\0".join([info.get_vendor(), info.get_renderer(), info.get_version()]))
+        for stage, srcs in (("vert", vert), ("frag", frag), ("geom", geom)):
+            h.update("\0%s\0%d\0" % (stage, len(srcs)))
+            for src in srcs:
+                h.update("%d\0" % len(src))
+                h.update(src)
+        return h.hexdigest()
+
+    def _fname(self, key):
+        return os.path.join(self.path, key+".bin")
+
+    def get(self, key):
+        """Return the (format, binary) pair for key, or None"""
+        binary = self.binaries.get(key)
+        if binary is None and self.path is not None:
+            try:
+                with open(self._fname(key), "rb") as f:
+                    data = f.read()
+                binary = struct.unpack("<I", data[:4])[0], data[4:]
+                self.binaries[key] = binary
+            except (IOError, OSError, struct.error):
+                binary = None
+        if binary is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return binary
+
+    def put(self, key, format, data):
+        self.binaries[key] = (format, data)
+        if self.path is not None:
+            try:
+                if not os.path.exists(self.path):
+                    os.makedirs(self.path)
+                # write then rename, so readers never see partial files
+                tmp_name = self._fname(key)+".%d.tmp" % os.getpid()
+                with open(tmp_name, "wb") as f:
+                    f.write(struct.pack("<I", format))
+                    f.write(data)
+                if os.path.exists(self._fname(key)):
+                    os.remove(self._fname(key))
+                os.rename(tmp_name, self._fname(key))
+            except (IOError, OSError) as e:
+                print("Could not write shader cache: %s" % e)
+
+    def discard(self, key):
+        self.binaries.pop(key, None)
+        if self.path is not None:
+            try:
+                os.remove(self._fname(key))
+            except OSError:
+                pass
+
+# shared program cache; set the environment variable pf_shader_cache
+# to change the directory, or to an empty string to keep it in memory only
+program_cache = ProgramCache(os.environ.get("pf_shader_cache", 
+                             os.path.join(os.path.expanduser("~"), ".pyspheregl", "shader_cache")) or None)
 
 
 # remove version lines from input shaders and replace with our own
 def version_clean(st):    
     return "\n".join([line.strip() for line in st.splitlines() if not line.startswith('#version')])
 
-def shader_from_file(verts, frags,  geoms=None, path="shaders", version="430 core"):
-    """Load vertex and fragment shaders from a list of files, and return the compiled shader"""
+def shader_from_file(verts, frags,  geoms=None, path="shaders", version="430 core", cache=program_cache):
+    """Load vertex and fragment shaders from a list of files, and return the compiled shader.
+    If cache is not None, the linked program is loaded from/saved to the given ProgramCache."""
     v_shaders = []
     v_shaders.append("#version "+version+"\n")
     
@@ -96,31 +186,76 @@ def shader_from_file(verts, frags,  geoms=None, path="shaders", version="430 cor
                     print os.path.basename(geom),
                     g_shaders.append(version_clean(f.read()))
          
-    _shader = Shader(vert=v_shaders, frag=f_shaders, geom=g_shaders)
+    _shader = Shader(vert=v_shaders, frag=f_shaders, geom=g_shaders, cache=cache)
     
     return _shader
 
 class Shader:
     # vert, frag and geom take arrays of source strings
     # the arrays will be concattenated into one string by OpenGL
-    def __init__(self, vert = [], frag = [], geom = []):
+    # if cache is a ProgramCache, the linked program binary
+    # is reused if possible, instead of compiling the sources
+    def __init__(self, vert = [], frag = [], geom = [], cache=None):
         # create the program handle
         self.handle = glCreateProgram()
         # we are not linked yet
         self.linked = False
         
         self.srcs = vert+frag+geom
+        self.uniforms = {}
+        self.attribs = {}
+        self.bound = False
+
+        if cache is not None and not cache.supported():
+            cache = None
+        if cache is not None:
+            key = cache.key(vert, frag, geom)
+            if self.load_binary(cache, key):
+                return
+
         # create the vertex shader
         self.createShader(vert, GL_VERTEX_SHADER)
         # create the fragment shader
         self.createShader(frag, GL_FRAGMENT_SHADER)
         # the geometry shader will be the same, once pyglet supports the extension
         self.createShader(geom, GL_GEOMETRY_SHADER_EXT)
-        self.uniforms = {}
-        self.attribs = {}
-        self.bound = False
+        if cache is not None:
+            glProgramParameteri(self.handle, GL_PROGRAM_BINARY_RETRIEVABLE_HINT, GL_TRUE)
         # attempt to link the program
         self.link()
+        if cache is not None:
+            self.save_binary(cache, key)
+
+    def load_binary(self, cache, key):
+        # try and load the linked program from the cache
+        # returns True if successful
+        binary = cache.get(key)
+        if binary is None:
+            return False
+        format, data = binary
+        glProgramBinary(self.handle, format, create_string_buffer(data, len(data)), len(data))
+        status = c_int(0)
+        glGetProgramiv(self.handle, GL_LINK_STATUS, byref(status))
+        if not status:
+            # rejected, e.g. after a driver update; start again from source
+            print("Cached shader binary rejected; recompiling")
+            cache.discard(key)
+            glDeleteProgram(self.handle)
+            self.handle = glCreateProgram()
+            return False
+        self._update_after_link()
+        return True
+
+    def save_binary(self, cache, key):
+        # store the linked program in the cache
+        length = GLint(0)
+        glGetProgramiv(self.handle, GL_PROGRAM_BINARY_LENGTH, byref(length))
+        if length.value<=0:
+            return
+        data = create_string_buffer(length.value)
+        format = GLenum(0)
+        glGetProgramBinary(self.handle, length.value, None, byref(format), data)
+        cache.put(key, format.value, data.raw)
 
     def createShader(self, strings, type):
         count = len(strings)
@@ -179,16 +314,18 @@ class Shader:
         
         if not status:            
             raise GLSLError("Failed to link shader")
-        else:
-            # all is well, so we are linked
-            glGetProgramiv(self.handle, GL_INFO_LOG_LENGTH, byref(temp))            
-            self.linked = True
+        self._update_after_link()
+
+    def _update_after_link(self):
+        # all is well, so we are linked
+        self.linked = True
 
         AUL = GLint()
         glGetProgramiv(self.handle, GL_ACTIVE_UNIFORM_MAX_LENGTH,
                           byref(AUL))
         self._ACTIVE_UNIFORM_MAX_LENGTH = AUL.value
         self._update_uniform_types()
+        self._update_uniform_setters()
 
     def bind(self):
         # bind the program
@@ -207,6 +344,11 @@ class Shader:
         if name not in self.uniforms:
             self.uniforms[name] = glGetUniformLocation(self.handle, name)
         return self.uniforms[name]
+
+    def _uniform_changed(self, name):
+        # forget the last value set through __setitem__, because
+        # the uniform has been written some other way
+        self._uniform_values.pop(name, None)
         
     # upload a floating point uniform
     # this program must be currently bound
@@ -221,6 +363,7 @@ class Shader:
                 4 : glUniform4f
                 # retrieve the uniform location, and set
             }[len(vals)](self.get_uniform(name), *vals)
+            self._uniform_changed(name)
             
     def __enter__(self):
         self.bind()
@@ -241,6 +384,7 @@ class Shader:
                 4 : glUniform4i
                 # retrieve the uniform location, and set
             }[len(vals)](self.get_uniform(name), *vals)
+            self._uniform_changed(name)
 
     # upload a uniform matrix
     # works with matrices stored as lists,
@@ -250,14 +394,17 @@ class Shader:
         loc = self.get_uniform(name)
         # uplaod the 4x4 floating point matrix
         glUniformMatrix4fv(loc, 1, False, (c_float * 16)(*mat))
+        self._uniform_changed(name)
 
     def uniform_mat4(self, name, mat):
         loc = self.get_uniform(name)
         glUniformMatrix4fv(loc, 1, False, mat.astype(np.float32).ctypes.data_as(POINTER(c_float)))
+        self._uniform_changed(name)
 
     def uniform_mat3(self, name, mat):
         loc = self.get_uniform(name)
         glUniformMatrix3fv(loc, 1, False, mat.astype(np.float32).ctypes.data_as(POINTER(c_float)))
+        self._uniform_changed(name)
 
     # this program must be currently bound
     # set the vertex attribute to a *constant* value 
@@ -331,12 +478,20 @@ class Shader:
     
     @property
     def active_uniforms(self):
-        """Query OpenGL for a list of active uniforms.
+        """List of active uniforms (queried once, when the program is linked).
   
         This is needed, because we are only allowed to set and query the
         values of active uniforms.
   
         """
+        return self._active_uniforms
+
+    def has_uniform(self, var):
+        """True if var is an active uniform in this program"""
+        return var in self._uniform_setters
+
+    def _query_active_uniforms(self):
+        """Query OpenGL for a list of active uniforms."""
         # Query number of active uniforms
         nr_uniforms = GLint()
         glGetProgramiv(self.handle, GL_ACTIVE_UNIFORMS,
@@ -350,11 +505,52 @@ class Shader:
   
         uniforms = []
         for i in range(nr_uniforms):
-            glGetActiveUniform(self.handle, i, 20, byref(length), byref(size),
+            glGetActiveUniform(self.handle, i, self._ACTIVE_UNIFORM_MAX_LENGTH, byref(length), byref(size),
                                   byref(enum), name)
-            uniforms.append(name.value)
+            # arrays are reported as name[0]
+            uniforms.append(name.value.split('[')[0])
   
         return uniforms
+
+    def _update_uniform_setters(self):
+        """Cache the location, size and setter function of every active uniform,
+        so that setting a uniform is a dictionary lookup and a single GL call.
+
+        Also clears the record of the last value set for each uniform, which 
+        __setitem__ uses to skip uniforms that have not changed.
+        """
+        self._active_uniforms = self._query_active_uniforms()
+        self._uniform_setters = {}
+        self._uniform_values = {}
+        for var in self._active_uniforms:
+            # uniforms we can't parse from the source (e.g. struct members)
+            # or locate (e.g. in uniform blocks) can't be set with __setitem__
+            if var in self._uniform_type_info and self.get_uniform(var) != -1:
+                self._uniform_setters[var] = self._make_uniform_setter(var)
+
+    def _make_uniform_setter(self, var):
+        # return a function which sets var from a list of values, 
+        # and the number of values it expects
+        loc, container, container_nested, dtype = \
+             self._uniform_loc_storage_and_type(var)
+        var_info = self._uniform_type_info[var]
+        count, kind, size = [var_info[k] for k in 'array', 'kind', 'size']
+
+        if kind == 'mat':
+            set_func = getattr(gl, 'glUniformMatrix%dfv' % np.sqrt(size))
+            def setter(value):
+                set_func(loc, count, True, container(*value))
+        else:
+            if kind == 'int':
+                type_code = 'i'
+            else:
+                type_code = 'f'
+  
+            # Setter function, named something like glUniform4iv
+            set_func = getattr(gl, 'glUniform%d%sv' % (size, type_code))
+            def setter(value):
+                set_func(loc, count, container(*value))
+        return setter, size * count
   
     def _update_uniform_types(self):
         """Determine the numeric types of uniform variables.
@@ -458,10 +654,9 @@ class Shader:
         else:
             data_type = GLfloat
   
-        assert glIsProgram(self.handle) == True
         assert self.linked
   
-        loc = glGetUniformLocation(self.handle, var)
+        loc = self.get_uniform(var)
   
         if loc == -1:
             raise RuntimeError("Could not query uniform location "
@@ -474,17 +669,20 @@ class Shader:
   
     @if_in_use
     def __setitem__(self, var, value):
-        """Set uniform variable value.
+        """Set uniform variable value. Values which are the same
+        as the last value set are not uploaded again.
   
         Please note that matrices must be specified in row-major format.
   
         """
-        loc, container, container_nested, dtype = \
-             self._uniform_loc_storage_and_type(var)
-
-        
-        var_info = self._uniform_type_info[var]
-        count, kind, size = [var_info[k] for k in 'array', 'kind', 'size']
+        try:
+            setter, expected_size = self._uniform_setters[var]
+        except KeyError:
+            if var not in self.active_uniforms:
+                raise GLSLError("Uniform '%s' is not active.  Make sure the "
+                                "variable is used in the source code." % var)
+            raise ValueError("Uniform variable '%s' is not defined in "
+                             "shader source." % var)
   
         # Ensure the value is given as a list
         try:
@@ -492,30 +690,19 @@ class Shader:
         except TypeError:
             value = [value]
   
-        expected_size = var_info['size'] * var_info['array']
-        if len(value) != var_info['size'] * var_info['array']:
+        if len(value) != expected_size:
+            var_info = self._uniform_type_info[var]
             varname = var
             if var_info['array'] > 0:
                 varname += '[%d]' % var_info['array']
             raise ValueError("Invalid input size (%s) for (%s) size '%s'." \
                              % (len(value), expected_size, varname))
-  
-        if var_info['kind'] == 'mat':
-            set_func_name = 'glUniformMatrix%dfv' % np.sqrt(var_info['size'])
-            set_func = getattr(gl, set_func_name)
-            set_func(loc, count, True, container(*value))
-        else:
-            if var_info['kind'] == 'int':
-                type_code = 'i'
-            else:
-                type_code = 'f'
-  
-            # Setter function, named something like glUniform4iv
-            set_func_name = 'glUniform%d%sv' % (var_info['size'],
-                                                type_code)
-  
-            set_func = getattr(gl, set_func_name)
-            set_func(loc, count, container(*value))
+
+        # skip the upload if nothing has changed
+        if self._uniform_values.get(var) == value:
+            return
+        setter(value)
+        self._uniform_values[var] = value
   
     def __getitem__(self, var):
         """Get uniform value.
@@ -26,6 +26,18 @@ class ShaderVBO:
             
             # set the locations from the shader given the buffer names
             for name,vbuf in buffers.items():
+                if vbuf.fields is not None:
+                    # interleaved buffer; the field names are the attribute names
+                    for field in vbuf.fields:
+                        id = self.shader.attribute_location(field)
+                        if id<0:
+                            raise GLSLError("Could not find attribute %s in shader" % field)
+                        vbuf.field_ids[field] = id
+                        print("attr: %s.%s -> %d" % (name, field, id))
+                    vbuf.name = name
+                    self.buffers[name] = vbuf
+                    vbos.append(vbuf)
+                    continue
                 id = self.shader.attribute_location(name)                
                 if id<0:
                     raise GLSLError("Could not find attribute %s in shader" % name)
@@ -71,14 +83,15 @@ class ShaderVBO:
     def __setitem__(self, var, value):
         """Override setting uniforms so that they actually write to the shader,
         as if they were just ordinary variables"""
-        if var in self.shader.active_uniforms:
+        if self.shader.has_uniform(var):
             self.shader.__setitem__(var, value)
 
     def set_texture(self, name, texture):
         """Change the named texture to the given texture ID"""
         self.textures[self.tex_names[name]] = texture
 
-    def draw(self, vars=None, n_prims=0, textures=None, primitives=None, attribs=None):
+    def draw(self, vars=None, n_prims=0, textures=None, primitives=None, attribs=None, n_vtxs=None):
+        # n_vtxs draws only the first n_vtxs indices (default: all of them)
         vars = vars or {}
         attribs = attribs or {}
 
@@ -99,7 +112,7 @@ class ShaderVBO:
 
         self.shader.draw(vao=self.vao, textures=textures, 
                         vars=vars, n_prims=n_prims, primitives=self.primitives, attribs=attribs,
-                        n_vtxs=self.n_vtxs)
+                        n_vtxs=self.n_vtxs if n_vtxs is None else n_vtxs)
         
   
     